@@ -1,55 +1,72 @@
 from datetime import datetime, timedelta
-from collections import defaultdict
 
+import pandas as pd
 import streamlit as st
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 
+import charts
+from chat_store import build_store, date_to_ts, day_number, ts_to_date, user_bucket_counts
 
-def parse_date(date_str):
-    return datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S")
+DEFAULT_DAYS_PER_PERIOD = 20
+# При большем числе периодов подписи оси X расставляет matplotlib, а не по одной на период
+MAX_PERIOD_TICKS = 30
 
 
-def count_words(text):
-    if isinstance(text, list):
-        text = ' '.join(item['text'] if isinstance(item, dict) else item for item in text)
-    return len(text.split())
+def period_activity(store, start_date, end_date, days_per_period):
+    """Сообщения и слова по пользователям за каждый период"""
+    # Периоды собираются из дневных ячеек куба активности, а не из отдельных сообщений
+    cube = store.cube
+    rows = store.cube_slice(start_date, end_date)
+    day, user = cube["day"][rows], cube["user"][rows]
 
+    start_day = day_number(date_to_ts(start_date))
+    n_periods = (day_number(date_to_ts(end_date)) - start_day) // days_per_period + 1
+    period = (day - start_day) // days_per_period
 
-@st.cache_data
-def preprocess_messages(messages):
-    # Добавляем поле parsed_date для каждого сообщения
-    for msg in messages:
-        if 'parsed_date' not in msg:
-            try:
-                msg['parsed_date'] = parse_date(msg['date'])
-            except Exception:
-                msg['parsed_date'] = None
-    return messages
+    n_users = len(store.users)
+    message_counts = user_bucket_counts(user, period, n_periods, n_users, weights=cube["messages"][rows])
+    word_counts = user_bucket_counts(user, period, n_periods, n_users, weights=cube["words"][rows])
 
+    period_labels = []
+    dt = datetime.combine(start_date, datetime.min.time())
+    for _ in range(n_periods):
+        period_labels.append(dt)
+        dt += timedelta(days=days_per_period)
 
-@st.cache_data
-def filter_messages(messages, start_date, end_date):
-    return [msg for msg in messages if msg.get('parsed_date') and start_date <= msg['parsed_date'].date() <= end_date]
+    active_users = message_counts.any(axis=1).nonzero()[0]
+    data_messages = {store.user_name(code): message_counts[code].tolist() for code in active_users}
+    data_words = {store.user_name(code): word_counts[code].tolist() for code in active_users}
 
+    return period_labels, data_messages, data_words
 
-def run_plugin(data):
-    messages = data.get("messages", [])
-    chat_name = data.get("name", "Чат")
 
-    if not messages:
-        st.warning("Нет сообщений в чате.")
-        return
+def default_params(store):
+    # По умолчанию анализируется вся история чата
+    if not len(store):
+        return None
+    return {
+        "start_date": ts_to_date(store.ts[0]),
+        "end_date": ts_to_date(store.ts[-1]),
+        "days_per_period": DEFAULT_DAYS_PER_PERIOD,
+    }
 
-    messages = preprocess_messages(messages)
 
-    min_date = min(msg['parsed_date'].date() for msg in messages if msg.get('parsed_date'))
-    max_date = max(msg['parsed_date'].date() for msg in messages if msg.get('parsed_date'))
+def select_params(store):
+    chat_name = store.name
+
+    defaults = default_params(store)
+    if defaults is None:
+        st.warning("Нет сообщений в чате.")
+        return None
+
+    min_date = defaults["start_date"]
+    max_date = defaults["end_date"]
 
     st.subheader(f"Анализ активности в чате: {chat_name}")
 
     col1, col2, col3 = st.columns(3)
     with col1:
-        days_per_period = st.number_input("Длина периода в днях", min_value=1, max_value=365, value=20)
+        days_per_period = st.number_input("Длина периода в днях", min_value=1, max_value=365, value=DEFAULT_DAYS_PER_PERIOD)
     with col2:
         start_date = st.date_input("Дата начала анализа", min_value=min_date, max_value=max_date, value=min_date)
     with col3:
@@ -57,69 +74,70 @@ def run_plugin(data):
 
     if start_date > end_date:
         st.error("Ошибка: дата начала не может быть позже даты конца.")
-        return
+        return None
 
-    filtered_messages = filter_messages(messages, start_date, end_date)
+    return {"start_date": start_date, "end_date": end_date, "days_per_period": days_per_period}
 
-    if not filtered_messages:
-        st.warning("Нет сообщений в выбранном периоде.")
-        return
 
-    current_period_start = datetime.combine(start_date, datetime.min.time())
-    current_period_end = current_period_start + timedelta(days=days_per_period)
+def compute(store, params):
+    return period_activity(store, params["start_date"], params["end_date"], params["days_per_period"])
 
-    period_counts = []
-    while current_period_start.date() <= end_date:
-        period_msgs = [
-            msg for msg in filtered_messages
-            if current_period_start <= msg['parsed_date'] < current_period_end
-        ]
-        period_counts.append(process_period(period_msgs))
-        current_period_start = current_period_end
-        current_period_end += timedelta(days=days_per_period)
 
-    period_labels = []
-    dt = datetime.combine(start_date, datetime.min.time())
-    for _ in range(len(period_counts)):
-        period_labels.append(dt)
-        dt += timedelta(days=days_per_period)
+def to_tables(result):
+    period_labels, data_messages, data_words = result
+    rows = [
+        {"Пользователь": user, "Начало периода": dt.date(), "Сообщений": messages, "Слов": words}
+        for user, counts in data_messages.items()
+        for dt, messages, words in zip(period_labels, counts, data_words[user])
+    ]
+    return {"periods": rows}
+
+
+def draw_figure(result):
+    return draw_activity_plot(*result)
 
-    users = set()
-    for period_count in period_counts:
-        users.update(period_count.keys())
 
-    data_messages = {user: [] for user in users}
-    data_words = {user: [] for user in users}
-    for period_count in period_counts:
-        for user in users:
-            data_messages[user].append(period_count.get(user, {}).get('messages', 0))
-            data_words[user].append(period_count.get(user, {}).get('words', 0))
+def draw_chart(result):
+    period_labels, data_messages, data_words = result
+    data = pd.concat([
+        charts.series_frame(period_labels, data_messages, kind={user: "Сообщения" for user in data_messages}),
+        charts.series_frame(period_labels, data_words, kind={user: "Слова" for user in data_words}),
+    ], ignore_index=True)
+    return charts.line_chart(data, "Дата начала периода", "Количество",
+                             "Количество сообщений и слов по пользователям", x_type="temporal", dash="kind")
+
+
+def render(result):
+    period_labels, data_messages, data_words = result
+
+    if not data_messages:
+        st.warning("Нет сообщений в выбранном периоде.")
+        return
 
-    st.pyplot(draw_activity_plot(period_labels, data_messages, data_words))
+    charts.show(lambda: draw_chart(result), lambda: draw_figure(result))
 
 
-def process_period(messages):
-    period_count = defaultdict(lambda: {'messages': 0, 'words': 0})
-    for msg in messages:
-        try:
-            sender = msg['from']
-            period_count[sender]['messages'] += 1
-            if msg.get("media_type") != "voice_message":
-                period_count[sender]['words'] += count_words(msg.get('text', ''))
-        except KeyError:
-            continue
-    return period_count
+def run_plugin(data, store=None):
+    if store is None:
+        store = build_store(data)
+    params = select_params(store)
+    if params is not None:
+        render(compute(store, params))
 
 
 def draw_activity_plot(period_labels, data_messages, data_words):
-    fig, ax = plt.subplots(figsize=(12, 6))
+    fig = Figure(figsize=(12, 6))
+    ax = fig.subplots()
     for user, counts in data_messages.items():
         ax.plot(period_labels, counts, label=f'{user} - Сообщения', marker='o')
     for user, counts in data_words.items():
         ax.plot(period_labels, counts, label=f'{user} - Слова', linestyle='--', marker='.')
 
-    ax.set_xticks(period_labels)
-    ax.set_xticklabels([dt.strftime('%Y-%m-%d') for dt in period_labels], rotation=45)
+    if len(period_labels) <= MAX_PERIOD_TICKS:
+        ax.set_xticks(period_labels)
+        ax.set_xticklabels([dt.strftime('%Y-%m-%d') for dt in period_labels], rotation=45)
+    else:
+        ax.tick_params(axis="x", labelrotation=45)
 
     ax.set_xlabel('Дата начала периода')
     ax.set_ylabel('Количество')
@@ -0,0 +1,175 @@
+"""Интерактивные графики Altair (Vega-Lite), которые рисует браузер.
+
+В браузер уходят только агрегированные серии: каждая прореживается на
+сервере алгоритмом LTTB до MAX_POINTS_PER_SERIES точек. Если графики
+выключены в боковой панели или Altair не установлен, показывается
+PNG из draw_figure плагина.
+
+Построенные графики и PNG кэшируются по (плагин, набор данных, параметры),
+см. render_scope: перезапуск страницы из-за другого виджета не рисует их заново.
+"""
+import contextvars
+import io
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+try:
+    import altair as alt
+except ImportError:
+    alt = None
+
+# Сколько точек одной серии отправлять в браузер
+MAX_POINTS_PER_SERIES = 500
+# Ключ переключателя в session_state (см. боковую панель в main.py)
+INTERACTIVE_KEY = "interactive_charts"
+# Сколько построенных графиков держать в памяти процесса
+MAX_RENDERED_CHARTS = 64
+# Параметры PNG как у st.pyplot
+PNG_OPTIONS = {"format": "png", "bbox_inches": "tight"}
+PNG_DPI = 200
+# Более широкие картинки st.image уменьшает при каждом показе, поэтому PNG
+# сразу рисуется не шире этого (с запасом на bbox_inches="tight")
+MAX_PNG_WIDTH = 1400
+
+# Ключ вывода текущего плагина (см. render_scope)
+_render_key = contextvars.ContextVar("render_key", default=None)
+
+
+def lttb(y, n_out):
+    """Индексы точек, оставляемых алгоритмом Largest-Triangle-Three-Buckets.
+
+    Точки считаются равноотстоящими по x (часы, дни, периоды), первая и
+    последняя сохраняются всегда, из каждой корзины между ними берётся точка,
+    образующая наибольший треугольник с уже выбранной и средней следующей корзины.
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    y = np.asarray(y, dtype=np.float64)
+    x = np.arange(n, dtype=np.float64)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        selected[i + 1] = a
+    return selected
+
+
+def series_frame(x, series, n_points=MAX_POINTS_PER_SERIES, **columns):
+    """Длинная таблица x / value / series для Altair, каждая серия прорежена до n_points.
+
+    columns — дополнительные колонки: имя -> {серия: значение}.
+    """
+    frames = []
+    x = np.asarray(x)
+    for name, values in series.items():
+        keep = lttb(values, n_points)
+        frame = pd.DataFrame({"x": x[keep], "value": np.asarray(values)[keep], "series": name})
+        for column, by_series in columns.items():
+            frame[column] = by_series[name]
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=["x", "value", "series"])
+
+
+def line_chart(data, x_title, y_title, title, x_type="ordinal", x_sort=None, dash=None):
+    """Линейный график с подсказками, масштабированием и выделением серии по клику на легенде"""
+    highlight = alt.selection_point(fields=["series"], bind="legend")
+    encoding = {
+        "x": alt.X("x", type=x_type, title=x_title, sort=x_sort),
+        "y": alt.Y("value:Q", title=y_title),
+        "color": alt.Color("series:N", title=None),
+        "opacity": alt.condition(highlight, alt.value(1.0), alt.value(0.15)),
+        "tooltip": [alt.Tooltip("series:N", title=""), alt.Tooltip("x", type=x_type, title=x_title),
+                    alt.Tooltip("value:Q", title=y_title)],
+    }
+    if dash is not None:
+        encoding["strokeDash"] = alt.StrokeDash(f"{dash}:N", title=None)
+    return (
+        alt.Chart(data, title=title)
+        .mark_line(point=len(data) <= MAX_POINTS_PER_SERIES)
+        .encode(**encoding)
+        .add_params(highlight)
+        .interactive(bind_y=False)
+    )
+
+
+@st.cache_resource
+def rendered_charts():
+    # Построенные графики общие для всех сессий: ключ -> график Altair или PNG
+    return {"charts": OrderedDict(), "lock": threading.Lock()}
+
+
+@contextmanager
+def render_scope(key):
+    """Графики, показанные внутри, кэшируются под ключом key (плагин, набор данных, параметры)"""
+    token = _render_key.set(key)
+    try:
+        yield
+    finally:
+        _render_key.reset(token)
+
+
+def cached(kind, extra, build):
+    """Результат build() из кэша или построенный заново; вне render_scope кэш не используется.
+
+    extra — то, от чего вывод зависит помимо результата compute (например, выбор в виджете render).
+    """
+    scope = _render_key.get()
+    if scope is None:
+        return build()
+    key = (scope, kind, extra)
+    cache = rendered_charts()
+    with cache["lock"]:
+        value = cache["charts"].get(key)
+        if value is not None:
+            cache["charts"].move_to_end(key)
+    if value is not None:
+        return value
+
+    # Строится без замка: сессии не ждут чужие графики
+    value = build()
+    with cache["lock"]:
+        charts = cache["charts"]
+        charts[key] = value
+        charts.move_to_end(key)
+        while len(charts) > MAX_RENDERED_CHARTS:
+            charts.popitem(last=False)
+    return value
+
+
+def figure_png(fig):
+    buf = io.BytesIO()
+    fig.savefig(buf, dpi=min(PNG_DPI, MAX_PNG_WIDTH / fig.get_figwidth()), **PNG_OPTIONS)
+    return buf.getvalue()
+
+
+def enabled():
+    return alt is not None and st.session_state.get(INTERACTIVE_KEY, True)
+
+
+def pyplot(figure, key=()):
+    """Показывает фигуру matplotlib из figure() как PNG, закэшированный в пределах render_scope"""
+    st.image(cached("png", key, lambda: figure_png(figure())), use_container_width=True)
+
+
+def show(chart, figure, key=()):
+    """Показывает интерактивный график или PNG matplotlib.
+
+    chart и figure — функции без аргументов: строится только то, что показывается.
+    """
+    if enabled():
+        st.altair_chart(cached("altair", key, chart), use_container_width=True)
+    else:
+        pyplot(figure, key)
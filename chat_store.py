@@ -0,0 +1,823 @@
+import uuid
+from array import array
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+import gap_engine
+
+# Значение для отсутствующего отправителя / ответа
+NO_ID = -1
+
+SECONDS_PER_DAY = 24 * 3600
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+# 1 января 1970 года — четверг, понедельник имеет номер 0
+_EPOCH_WEEKDAY = 3
+
+# Сколько дат накапливать перед векторным разбором
+DATE_BATCH_SIZE = 65536
+
+_NAT = np.iinfo(np.int64).min
+_INT32 = np.iinfo(np.int32)
+# Префикс для реакций своими эмодзи в словаре emojis
+CUSTOM_EMOJI_PREFIX = "custom:"
+# Предел шагов удвоения указателей в reply_threads (защита от циклов в повреждённых данных)
+MAX_THREAD_DOUBLINGS = 32
+
+
+def parse_dates(dates, unixtimes):
+    """Векторно разбирает поля date в секунды настенного времени.
+
+    Если date отсутствует или не разбирается, время восстанавливается из
+    date_unixtime со сдвигом часового пояса, вычисленным по остальным
+    сообщениям пачки.
+    """
+    try:
+        ts = np.array(dates, dtype="datetime64[s]").astype(np.int64)
+    except (ValueError, TypeError):
+        ts = np.array([_parse_one_date(value) for value in dates], dtype="datetime64[s]").astype(np.int64)
+
+    missing = ts == _NAT
+    if not missing.any():
+        return ts
+
+    unix = np.array([_parse_unixtime(value) for value in unixtimes], dtype=np.int64)
+    known = ~missing & (unix != _NAT)
+    offset = int(np.median(ts[known] - unix[known])) if known.any() else 0
+    restore = missing & (unix != _NAT)
+    ts[restore] = unix[restore] + offset
+
+    # Сообщения совсем без времени считаем отправленными вместе с предыдущим
+    missing = ts == _NAT
+    if missing.any():
+        last_known = np.maximum.accumulate(np.where(missing, 0, np.arange(len(ts))))
+        ts = ts[last_known]
+        ts[ts == _NAT] = 0
+    return ts
+
+
+def _parse_one_date(value):
+    try:
+        return np.datetime64(value, "s")
+    except (ValueError, TypeError):
+        return np.datetime64("NaT")
+
+
+def _parse_unixtime(value):
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return _NAT
+
+
+def ts_to_datetime(ts):
+    return _EPOCH + timedelta(seconds=int(ts))
+
+
+def ts_to_date(ts):
+    return date.fromordinal(_EPOCH_ORDINAL + int(ts) // SECONDS_PER_DAY)
+
+
+def date_to_ts(d):
+    """Время начала дня d в секундах"""
+    return (d.toordinal() - _EPOCH_ORDINAL) * SECONDS_PER_DAY
+
+
+def day_number(ts):
+    """Номер дня от 1970-01-01 для массива времён"""
+    return ts // SECONDS_PER_DAY
+
+
+def hour_of_day(ts):
+    return ts // 3600 % 24
+
+
+def day_weekday(day):
+    """День недели для массива номеров дней, 0 — понедельник"""
+    return (day + _EPOCH_WEEKDAY) % 7
+
+
+def user_bucket_counts(sender, bucket, n_buckets, n_users, weights=None):
+    """Матрица пользователь × корзина: количество (или сумма weights) сообщений"""
+    counts = np.bincount(sender.astype(np.int64) * n_buckets + bucket, weights=weights,
+                         minlength=n_users * n_buckets)
+    if weights is not None:
+        counts = np.rint(counts).astype(np.int64)
+    return counts.reshape(n_users, n_buckets)
+
+
+def compact_ints(values):
+    """int64-массив в int32, если значения помещаются (id сообщений Telegram — 32-битные)"""
+    if not len(values) or (values.min() >= _INT32.min and values.max() <= _INT32.max):
+        return values.astype(np.int32)
+    return values
+
+
+def _read_only(values):
+    values.flags.writeable = False
+    return values
+
+
+def unique_labels(names, keys):
+    """Подписи пользователей: отображаемое имя, а при совпадении имён — имя с ключом"""
+    counts = Counter(names)
+    return [name if counts[name] == 1 else f"{name} ({key})" for name, key in zip(names, keys)]
+
+
+def reaction_key(reaction):
+    """Эмодзи реакции; для своих эмодзи (custom_emoji) — id документа, у них нет символа"""
+    if reaction.get("emoji"):
+        return reaction["emoji"]
+    if reaction.get("document_id"):
+        return f"{CUSTOM_EMOJI_PREFIX}{reaction['document_id']}"
+    return reaction.get("type")
+
+
+def count_words(text):
+    if isinstance(text, list):
+        text = ' '.join(item['text'] if isinstance(item, dict) else item for item in text)
+    return len(text.split())
+
+
+class ChatStore:
+    """Колоночное представление сообщений чата (или нескольких, см. combine_stores).
+
+    Строится один раз на загруженный файл и передаётся всем плагинам,
+    чтобы они не разбирали заново список словарей из JSON.
+
+    Колонки сообщений (numpy-массивы одинаковой длины, строки отсортированы по ts):
+        ids       — id сообщения
+        ts        — время сообщения в секундах (настенное время чата, как в поле date)
+        sender    — индекс отправителя в users / user_ids или NO_ID
+        reply_to  — id сообщения, на которое отвечают, или NO_ID
+        media     — индекс типа медиа в media_types (0 — без медиа)
+        words     — количество слов в тексте (для голосовых — 0)
+        chat      — индекс чата в chat_names (ненулевой только в объединённом хранилище)
+
+    Строки отсортированы по времени, поэтому сообщения за диапазон дат —
+    это срез строк: store.ts[store.date_slice(start, end)] (двоичный поиск,
+    O(log n)). Сводки по дням и часам удобнее брать срезом куба (cube_slice).
+
+    Реакции хранятся отдельными плоскими таблицами:
+        reaction_msg / reaction_emoji / reaction_count — строка сообщения, индекс эмодзи, количество
+        reactor_msg / reactor_emoji / reactor_user    — кто ставил реакцию (по полю recent)
+
+    Пользователи различаются по from_id (user_ids), а не по имени: имена
+    меняются и совпадают. user_names — последние имена, users — уникальные
+    подписи для вывода (при совпадении имён к имени добавляется from_id).
+
+    В aggregates лежат предрасчитанные сводки (см. AGGREGATES): они
+    считаются при построении и сохраняются в дисковый кэш вместе с колонками.
+    """
+
+    MESSAGE_COLUMNS = ("ids", "ts", "sender", "reply_to", "media", "words", "chat")
+    REACTION_COLUMNS = ("reaction_msg", "reaction_emoji", "reaction_count")
+    REACTOR_COLUMNS = ("reactor_msg", "reactor_emoji", "reactor_user")
+    TABLES = {
+        "messages": MESSAGE_COLUMNS,
+        "reactions": REACTION_COLUMNS,
+        "reactors": REACTOR_COLUMNS,
+    }
+    COLUMNS = MESSAGE_COLUMNS + REACTION_COLUMNS + REACTOR_COLUMNS
+
+    def __init__(self, meta, user_names, media_types, emojis, columns, key=None, aggregates=None, user_ids=None):
+        self.meta = meta
+        self.user_names = user_names
+        self.user_ids = user_ids if user_ids is not None else list(user_names)
+        self.users = unique_labels(user_names, self.user_ids)
+        self.media_types = media_types
+        self.emojis = emojis
+        # Короткий идентификатор набора данных для ключей кэшей (хэш файла или случайный)
+        self.key = key if key is not None else uuid.uuid4().hex
+        # Хранилище общее для всех сессий, поэтому колонки и агрегаты только для чтения
+        for name in self.COLUMNS:
+            setattr(self, name, _read_only(columns[name]))
+
+        self.aggregates = dict(aggregates or {})
+        for name, func in AGGREGATES.items():
+            if name not in self.aggregates:
+                self.aggregates[name] = func(self)
+        for table in self.aggregates.values():
+            for values in table.values():
+                _read_only(values)
+
+    def __len__(self):
+        return len(self.ts)
+
+    @property
+    def name(self):
+        return self.meta.get("name") or "Чат"
+
+    @property
+    def chat_names(self):
+        # Объединённое хранилище перечисляет исходные чаты в meta["chats"]
+        return self.meta.get("chats") or [self.name]
+
+    def date_slice(self, start_date, end_date):
+        """Срез строк с сообщениями с start_date по end_date включительно.
+
+        Строки отсортированы по времени, поэтому границы ищутся двоичным поиском.
+        """
+        bounds = np.searchsorted(self.ts, [date_to_ts(start_date), date_to_ts(end_date) + SECONDS_PER_DAY])
+        return slice(int(bounds[0]), int(bounds[1]))
+
+    def cube_slice(self, start_date, end_date):
+        """Срез строк куба активности с start_date по end_date включительно"""
+        bounds = np.searchsorted(self.cube["day"], [day_number(date_to_ts(start_date)),
+                                                    day_number(date_to_ts(end_date)) + 1])
+        return slice(int(bounds[0]), int(bounds[1]))
+
+    @property
+    def user_totals(self):
+        return self.aggregates["user_totals"]
+
+    @property
+    def cube(self):
+        return self.aggregates["activity_cube"]
+
+    @property
+    def gaps(self):
+        return self.aggregates["chat_gaps"]
+
+    @property
+    def threads(self):
+        return self.aggregates["reply_threads"]
+
+    @property
+    def reply_edges(self):
+        return self.aggregates["reply_edges"]
+
+    @property
+    def reaction_matrix(self):
+        return self.aggregates["reaction_matrix"]
+
+    def columns(self):
+        return {name: getattr(self, name) for name in self.COLUMNS}
+
+    def tables(self):
+        return {table: {name: getattr(self, name) for name in names} for table, names in self.TABLES.items()}
+
+    def user_name(self, code):
+        return self.users[code]
+
+
+class ChatStoreBuilder:
+    """Накапливает сообщения в компактных буферах и собирает ChatStore"""
+
+    def __init__(self):
+        self._ids = array('q')
+        self._ts = array('q')
+        self._sender = array('i')
+        self._reply_to = array('q')
+        self._media = array('h')
+        self._words = array('i')
+        self._reaction_msg = array('i')
+        self._reaction_emoji = array('i')
+        self._reaction_count = array('i')
+        self._reactor_msg = array('i')
+        self._reactor_emoji = array('i')
+        self._reactor_user = array('i')
+        # from_id (или имя, если from_id нет) -> код пользователя; имена — по кодам
+        self._users = {}
+        self._user_names = []
+        self._media_types = {"": 0}
+        self._emojis = {}
+        # Даты разбираются пачками, см. _flush_dates
+        self._pending_dates = []
+        self._pending_unixtimes = []
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _flush_dates(self):
+        if self._pending_dates:
+            self._ts.frombytes(parse_dates(self._pending_dates, self._pending_unixtimes).tobytes())
+            self._pending_dates = []
+            self._pending_unixtimes = []
+
+    @staticmethod
+    def _intern(table, value):
+        code = table.get(value)
+        if code is None:
+            code = table[value] = len(table)
+        return code
+
+    def _user_code(self, name, user_id):
+        key = user_id or name
+        code = self._users.get(key)
+        if code is None:
+            code = self._users[key] = len(self._users)
+            self._user_names.append(name)
+        elif name:
+            # Сообщения идут по времени, так что остаётся последнее имя
+            self._user_names[code] = name
+        return code
+
+    def add(self, msg):
+        date_str = msg.get("date")
+        unixtime = msg.get("date_unixtime")
+        if date_str is None and unixtime is None:
+            return
+
+        row = len(self._ids)
+        self._pending_dates.append(date_str)
+        self._pending_unixtimes.append(unixtime)
+        if len(self._pending_dates) >= DATE_BATCH_SIZE:
+            self._flush_dates()
+
+        sender = msg.get("from")
+        media_type = msg.get("media_type") or ""
+        reply_to = msg.get("reply_to_message_id")
+
+        self._ids.append(msg.get("id", NO_ID))
+        self._sender.append(NO_ID if sender is None else self._user_code(sender, msg.get("from_id")))
+        self._reply_to.append(NO_ID if reply_to is None else reply_to)
+        self._media.append(self._intern(self._media_types, media_type))
+        if media_type == "voice_message":
+            self._words.append(0)
+        else:
+            try:
+                self._words.append(count_words(msg.get('text', '')))
+            except Exception:
+                self._words.append(0)
+
+        for reaction in msg.get("reactions", []):
+            emoji = reaction_key(reaction)
+            if not emoji:
+                continue
+            emoji_code = self._intern(self._emojis, emoji)
+            self._reaction_msg.append(row)
+            self._reaction_emoji.append(emoji_code)
+            self._reaction_count.append(reaction.get("count", 0))
+
+            # Используем recent для определения пользователей
+            for entry in reaction.get("recent", []):
+                user = entry.get("from")
+                if user:
+                    self._reactor_msg.append(row)
+                    self._reactor_emoji.append(emoji_code)
+                    self._reactor_user.append(self._user_code(user, entry.get("from_id")))
+
+    def add_many(self, messages):
+        for msg in messages:
+            self.add(msg)
+
+    def build(self, meta, key=None):
+        self._flush_dates()
+        columns = {
+            "ids": compact_ints(np.frombuffer(self._ids, dtype=np.int64)),
+            "ts": np.frombuffer(self._ts, dtype=np.int64),
+            "sender": np.frombuffer(self._sender, dtype=np.int32),
+            "reply_to": compact_ints(np.frombuffer(self._reply_to, dtype=np.int64)),
+            "media": np.frombuffer(self._media, dtype=np.int16),
+            "words": np.frombuffer(self._words, dtype=np.int32),
+            "chat": np.zeros(len(self._ids), dtype=np.int16),
+            "reaction_msg": np.frombuffer(self._reaction_msg, dtype=np.int32),
+            "reaction_emoji": np.frombuffer(self._reaction_emoji, dtype=np.int32),
+            "reaction_count": np.frombuffer(self._reaction_count, dtype=np.int32),
+            "reactor_msg": np.frombuffer(self._reactor_msg, dtype=np.int32),
+            "reactor_emoji": np.frombuffer(self._reactor_emoji, dtype=np.int32),
+            "reactor_user": np.frombuffer(self._reactor_user, dtype=np.int32),
+        }
+        # Копируем, чтобы массивы не зависели от буферов построителя
+        columns = {name: col.copy() for name, col in columns.items()}
+        sort_by_time(columns)
+        user_ids = list(self._users)
+        return ChatStore(meta, self._user_names, list(self._media_types), list(self._emojis),
+                         columns, key=key, user_ids=user_ids)
+
+
+def sort_by_time(columns):
+    """Упорядочивает строки сообщений по времени (на месте в словаре columns).
+
+    Ссылки на строки из таблиц реакций пересчитываются под новый порядок.
+    Возвращает новый номер каждой прежней строки или None, если порядок не изменился.
+    """
+    ts = columns["ts"]
+    if not len(ts) or (ts[1:] >= ts[:-1]).all():
+        return None
+    order = np.argsort(ts, kind="stable")
+    for name in ChatStore.MESSAGE_COLUMNS:
+        columns[name] = columns[name][order]
+    new_row = np.empty_like(order)
+    new_row[order] = np.arange(len(order))
+    for name in ("reaction_msg", "reactor_msg"):
+        columns[name] = new_row[columns[name]].astype(np.int32)
+    return new_row
+
+
+def user_totals(store):
+    """Количество сообщений и слов по каждому пользователю"""
+    valid = store.sender >= 0
+    n_users = len(store.users)
+    return {
+        "messages": np.bincount(store.sender[valid], minlength=n_users),
+        "words": np.bincount(store.sender[valid], weights=store.words[valid], minlength=n_users).astype(np.int64),
+    }
+
+
+def activity_cube(store):
+    """Разреженный куб активности день × час × чат × пользователь.
+
+    Для каждой непустой ячейки хранится число сообщений и слов. Строки
+    отсортированы по дню, поэтому диапазон дат — это срез (см. cube_slice),
+    а графики по часам, дням недели и периодам считаются суммированием ячеек
+    вместо прохода по всем сообщениям.
+    """
+    valid = store.sender >= 0
+    ts = store.ts[valid]
+    return _group_cube_cells(day_number(ts), hour_of_day(ts), store.chat[valid], store.sender[valid],
+                             None, store.words[valid])
+
+
+def _group_cube_cells(day, hour, chat, user, messages, words):
+    """Суммирует строки с одинаковыми (день, час, чат, пользователь) в ячейки куба.
+
+    messages — число сообщений в строке (None — по одному), words — число слов.
+    """
+    day = day.astype(np.int64)
+    n_users = int(user.max()) + 1 if len(user) else 1
+    n_chats = int(chat.max()) + 1 if len(chat) else 1
+    first_day = int(day.min()) if len(day) else 0
+
+    cell = (((day - first_day) * 24 + hour) * n_chats + chat) * n_users + user
+    cells, inverse = np.unique(cell, return_inverse=True)
+    user = cells % n_users
+    cells //= n_users
+    chat = cells % n_chats
+    cells //= n_chats
+    hour = cells % 24
+    day = cells // 24 + first_day
+    return {
+        "day": day.astype(np.int32),
+        "hour": hour.astype(np.int8),
+        "chat": chat.astype(np.int32),
+        "user": user.astype(np.int32),
+        "messages": np.rint(np.bincount(inverse, weights=messages, minlength=len(cells))).astype(np.int32),
+        "words": np.rint(np.bincount(inverse, weights=words, minlength=len(cells))).astype(np.int64),
+    }
+
+
+def chat_gaps(store):
+    """Паузы между сообщениями внутри каждого чата по убыванию длительности.
+
+    gap — длительность в секундах, end — строка сообщения, которым пауза
+    закончилась. Паузы не короче порога — это префикс (см. gap_engine.count_at_least).
+    """
+    gap, end = gap_engine.group_gaps(store.ts, store.chat if len(store.chat_names) > 1 else None)
+    order = gap_engine.descending(gap, end)
+    return {"gap": gap[order], "end": end[order].astype(np.int32)}
+
+
+def reply_threads(store):
+    """Ветки ответов для каждого сообщения.
+
+    parent — строка сообщения, на которое ответили (NO_ID, если его нет в
+    хранилище), depth — глубина в цепочке ответов (0 у сообщения без ответа),
+    thread — id первого сообщения цепочки.
+    """
+    order = np.argsort(store.ids, kind="stable")
+    sorted_ids = store.ids[order]
+    pos = np.minimum(np.searchsorted(sorted_ids, store.reply_to), max(len(order) - 1, 0))
+    found = (store.reply_to >= 0) & (sorted_ids[pos] == store.reply_to) if len(order) else np.zeros(0, dtype=bool)
+    parent = np.where(found, order[pos] if len(order) else pos, NO_ID).astype(np.int32)
+    depth, root = _thread_roots(parent)
+    return {"parent": parent, "depth": depth, "thread": store.ids[root]}
+
+
+def _thread_roots(parent):
+    """Глубина каждой строки в цепочке ответов и строка корня цепочки"""
+    # Удвоение указателей: за log2(глубины) шагов каждая строка доходит до корня цепочки
+    rows = np.arange(len(parent), dtype=np.int32)
+    ancestor = np.where(parent >= 0, parent, rows)
+    depth = (parent >= 0).astype(np.int32)
+    for _ in range(MAX_THREAD_DOUBLINGS):
+        if (ancestor[ancestor] == ancestor).all():
+            break
+        depth = depth + depth[ancestor] * (ancestor != rows)
+        ancestor = ancestor[ancestor]
+    return depth, ancestor
+
+
+def _find_rows(ids, targets):
+    """Строка с каждым id из targets (NO_ID, если его нет).
+
+    Сортируются только targets, а по ids делается один проход двоичного
+    поиска, поэтому при небольшом числе targets это быстрее сортировки ids.
+    """
+    wanted, inverse = np.unique(targets, return_inverse=True)
+    rows = np.full(len(wanted), NO_ID, dtype=np.int32)
+    if len(wanted):
+        pos = np.minimum(np.searchsorted(wanted, ids), len(wanted) - 1)
+        hit = np.flatnonzero(wanted[pos] == ids)
+        # При повторе id берётся первая строка, как в reply_threads
+        rows[pos[hit][::-1]] = hit[::-1]
+    return rows[inverse]
+
+
+def reply_edges(store):
+    """Разреженная матрица ответов пользователь × пользователь в формате COO.
+
+    source ответил target count раз; ответы самому себе не учитываются.
+    Строки отсортированы по (source, target).
+    """
+    # reply_threads считается раньше (порядок AGGREGATES)
+    parent = store.aggregates["reply_threads"]["parent"]
+    replies = (parent >= 0) & (store.sender >= 0)
+    source = store.sender[replies]
+    target = store.sender[parent[replies]]
+    keep = (target >= 0) & (source != target)
+    n_users = max(len(store.users), 1)
+    pairs, counts = np.unique(source[keep].astype(np.int64) * n_users + target[keep], return_counts=True)
+    return {
+        "source": (pairs // n_users).astype(np.int32),
+        "target": (pairs % n_users).astype(np.int32),
+        "count": counts.astype(np.int32),
+    }
+
+
+def reaction_matrix(store):
+    """Разреженная матрица пользователь × эмодзи (по полю recent) в формате COO"""
+    return _group_pairs(store.reactor_user, store.reactor_emoji, np.ones(len(store.reactor_user), dtype=np.int32))
+
+
+def _group_pairs(first, second, count, names=("user", "emoji")):
+    """Суммирует count по одинаковым парам (first, second), строки отсортированы по парам.
+
+    names — имена колонок first и second в результате.
+    """
+    n_second = int(second.max()) + 1 if len(second) else 1
+    pairs, inverse = np.unique(first.astype(np.int64) * n_second + second, return_inverse=True)
+    return {
+        names[0]: (pairs // n_second).astype(np.int32),
+        names[1]: (pairs % n_second).astype(np.int32),
+        "count": np.bincount(inverse, weights=count, minlength=len(pairs)).astype(np.int32),
+    }
+
+
+def emoji_totals(store):
+    """Общее количество каждой реакции (по счётчикам count, а не recent)"""
+    return {"count": np.bincount(store.reaction_emoji, weights=store.reaction_count,
+                                 minlength=len(store.emojis)).astype(np.int64)}
+
+
+def message_reactions(store):
+    """Число реакций на каждое сообщение, у которого они есть, по убыванию"""
+    rows, inverse = np.unique(store.reaction_msg, return_inverse=True)
+    totals = np.bincount(inverse, weights=store.reaction_count, minlength=len(rows)).astype(np.int64)
+    order = np.lexsort((rows, -totals))
+    return {"msg": rows[order].astype(np.int32), "total": totals[order]}
+
+
+def merge_user_totals(old, new, appended):
+    n_users = max(len(old["messages"]), len(new["messages"]))
+    return {name: _pad(old[name], n_users) + _pad(new[name], n_users) for name in old}
+
+
+def _pad(values, length):
+    return np.pad(values, (0, length - len(values)))
+
+
+def merge_reaction_matrix(old, new, appended):
+    columns = {name: np.concatenate([old[name], new[name]]) for name in old}
+    return _group_pairs(columns["user"], columns["emoji"], columns["count"])
+
+
+def merge_emoji_totals(old, new, appended):
+    n_emojis = max(len(old["count"]), len(new["count"]))
+    return {"count": _pad(old["count"], n_emojis) + _pad(new["count"], n_emojis)}
+
+
+def merge_activity_cube(old, new, appended):
+    columns = {name: np.concatenate([old[name], new[name]]) for name in old}
+    return _group_cube_cells(columns["day"], columns["hour"], columns["chat"], columns["user"],
+                             columns["messages"], columns["words"])
+
+
+def _merge_descending(old, new, value, row):
+    """Сливает две сводки, отсортированные по убыванию value, а при равенстве — по строке row"""
+    # Пара (-value, row) укладывается в одно число int64: value и row меньше 2^31
+    old_key = -old[value].astype(np.int64) * 2 ** 32 + old[row]
+    new_key = -new[value].astype(np.int64) * 2 ** 32 + new[row]
+    pos = np.searchsorted(old_key, new_key)
+    return {name: np.insert(old[name], pos, new[name]) for name in old}
+
+
+def merge_chat_gaps(old, new, appended):
+    # Пауза меняется только у новых сообщений и у сообщений сразу после них,
+    # остальные паузы base остаются (хранилище одного чата, см. append_store)
+    ts = appended["columns"]["ts"]
+    changed = np.zeros(len(ts) + 1, dtype=bool)
+    changed[appended["added_rows"]] = True
+    changed[appended["added_rows"] + 1] = True
+    changed[0] = False
+    changed = changed[:len(ts)]
+
+    end = appended["base_rows"][old["end"]]
+    keep = ~changed[end]
+    rows = np.flatnonzero(changed)
+    gap = ts[rows] - ts[rows - 1]
+    order = gap_engine.descending(gap, rows)
+    return _merge_descending({"gap": old["gap"][keep], "end": end[keep].astype(np.int32)},
+                             {"gap": gap[order], "end": rows[order].astype(np.int32)}, "gap", "end")
+
+
+def merge_reply_threads(old, new, appended):
+    # Родитель ищется только у новых сообщений и у старых, чей родитель не был найден:
+    # он мог прийти в новом экспорте. Глубины пересчитываются удвоением указателей.
+    columns, base_rows = appended["columns"], appended["base_rows"]
+    parent = np.full(len(columns["ts"]), NO_ID, dtype=np.int32)
+    parent[base_rows] = np.where(old["parent"] >= 0, base_rows[old["parent"]], NO_ID)
+
+    unresolved = np.zeros(len(parent), dtype=bool)
+    unresolved[appended["added_rows"]] = True
+    unresolved[base_rows[old["parent"] < 0]] = True
+    rows = np.flatnonzero(unresolved & (columns["reply_to"] >= 0))
+    parent[rows] = _find_rows(columns["ids"], columns["reply_to"][rows])
+    depth, root = _thread_roots(parent)
+    return {"parent": parent, "depth": depth, "thread": columns["ids"][root]}
+
+
+def merge_reply_edges(old, new, appended):
+    # Новые пары дают только строки, у которых родитель появился при дописывании
+    # (reply_threads сливается раньше, порядок AGGREGATE_MERGES)
+    parent = appended["aggregates"]["reply_threads"]["parent"]
+    sender = appended["columns"]["sender"]
+    had_parent = np.zeros(len(parent), dtype=bool)
+    had_parent[appended["base_rows"]] = appended["base"].threads["parent"] >= 0
+    rows = np.flatnonzero((parent >= 0) & ~had_parent & (sender >= 0))
+    source, target = sender[rows], sender[parent[rows]]
+    keep = (target >= 0) & (source != target)
+    return _group_pairs(np.concatenate([old["source"], source[keep]]),
+                        np.concatenate([old["target"], target[keep]]),
+                        np.concatenate([old["count"], np.ones(int(keep.sum()), dtype=np.int32)]),
+                        names=("source", "target"))
+
+
+def merge_message_reactions(old, new, appended):
+    # Реакции новых сообщений не пересекаются с реакциями base
+    return _merge_descending(
+        {"msg": appended["base_rows"][old["msg"]].astype(np.int32), "total": old["total"]},
+        {"msg": appended["added_rows"][new["msg"]].astype(np.int32), "total": new["total"]},
+        "total", "msg",
+    )
+
+
+# Сводки, которые считаются при построении хранилища: имя -> функция(store) -> {колонка: массив}.
+# Все колонки одной сводки имеют одинаковую длину (так они сохраняются в дисковый кэш).
+AGGREGATES = {
+    "user_totals": user_totals,
+    "activity_cube": activity_cube,
+    "chat_gaps": chat_gaps,
+    "reply_threads": reply_threads,
+    "reply_edges": reply_edges,
+    "reaction_matrix": reaction_matrix,
+    "emoji_totals": emoji_totals,
+    "message_reactions": message_reactions,
+}
+
+# Слияние сводок при дописывании сообщений (см. append_store): имя -> функция(старая, новая, appended).
+# appended — итоговые колонки, base, новые номера строк base и extra и уже слитые сводки.
+# Сводки без функции слияния пересчитываются по всему хранилищу.
+AGGREGATE_MERGES = {
+    "user_totals": merge_user_totals,
+    "activity_cube": merge_activity_cube,
+    "chat_gaps": merge_chat_gaps,
+    "reply_threads": merge_reply_threads,
+    "reply_edges": merge_reply_edges,
+    "reaction_matrix": merge_reaction_matrix,
+    "emoji_totals": merge_emoji_totals,
+    "message_reactions": merge_message_reactions,
+}
+
+
+def chat_meta(data):
+    return {field: data.get(field) for field in ("name", "type", "id")}
+
+
+def _remap(codes, mapping):
+    # Последний элемент mapping отвечает коду NO_ID (индекс -1)
+    return mapping[codes]
+
+
+def _merge_users(users, names, store):
+    """Добавляет пользователей store в общий словарь from_id -> код, возвращает карту кодов"""
+    codes = []
+    for user_id, name in zip(store.user_ids, store.user_names):
+        code = users.get(user_id)
+        if code is None:
+            code = users[user_id] = len(names)
+            names.append(name)
+        else:
+            names[code] = name
+        codes.append(code)
+    return np.array(codes + [NO_ID], dtype=np.int32)
+
+
+def combine_stores(stores, key=None, names=None):
+    """Объединяет хранилища нескольких чатов в одно с колонкой chat.
+
+    Пользователи сводятся по from_id, типы медиа и эмодзи — по значению. id сообщений
+    сдвигаются так, чтобы не пересекаться между чатами, вместе с ними
+    сдвигаются и ссылки reply_to: ответ остаётся внутри своего чата.
+    names — подписи чатов (по умолчанию их названия).
+    """
+    users, user_names, media_types, emojis = {}, [], {"": 0}, {}
+    parts = {name: [] for name in ChatStore.COLUMNS}
+    row_offset = id_offset = 0
+    for chat, store in enumerate(stores):
+        user_map = _merge_users(users, user_names, store)
+        media_map = np.array([ChatStoreBuilder._intern(media_types, media) for media in store.media_types], dtype=np.int16)
+        emoji_map = np.array([ChatStoreBuilder._intern(emojis, emoji) for emoji in store.emojis] + [NO_ID], dtype=np.int32)
+
+        # Сдвинутые id могут не поместиться в int32
+        parts["ids"].append(np.where(store.ids >= 0, store.ids.astype(np.int64) + id_offset, NO_ID))
+        parts["ts"].append(store.ts)
+        parts["sender"].append(_remap(store.sender, user_map))
+        parts["reply_to"].append(np.where(store.reply_to >= 0, store.reply_to.astype(np.int64) + id_offset, NO_ID))
+        parts["media"].append(_remap(store.media, media_map))
+        parts["words"].append(store.words)
+        parts["chat"].append(np.full(len(store), chat, dtype=np.int16))
+        parts["reaction_msg"].append(store.reaction_msg + row_offset)
+        parts["reaction_emoji"].append(_remap(store.reaction_emoji, emoji_map))
+        parts["reaction_count"].append(store.reaction_count)
+        parts["reactor_msg"].append(store.reactor_msg + row_offset)
+        parts["reactor_emoji"].append(_remap(store.reactor_emoji, emoji_map))
+        parts["reactor_user"].append(_remap(store.reactor_user, user_map))
+
+        row_offset += len(store)
+        if len(store):
+            id_offset += max(int(store.ids.max()), int(store.reply_to.max()), 0) + 1
+
+    columns = {name: np.concatenate(chunks) for name, chunks in parts.items()}
+    for name in ("ids", "reply_to"):
+        columns[name] = compact_ints(columns[name])
+    sort_by_time(columns)
+    meta = {
+        "name": f"Все чаты ({len(stores)})",
+        "type": "combined",
+        "id": None,
+        "chats": list(names) if names is not None else [store.name for store in stores],
+    }
+    user_ids = list(users)
+    return ChatStore(meta, user_names, list(media_types), list(emojis), columns,
+                     key=key, user_ids=user_ids)
+
+
+def append_store(base, extra, key=None, meta=None):
+    """Дописывает к хранилищу base сообщения из extra — более нового экспорта того же чата.
+
+    Словари пользователей, типов медиа и эмодзи base дополняются новыми
+    значениями, коды в extra перекодируются. Сводки считаются только по
+    новым сообщениям и сливаются со сводками base через AGGREGATE_MERGES,
+    поэтому сортировок по всей истории нет: её строки только перенумеровываются.
+    """
+    users, user_names = {}, []
+    _merge_users(users, user_names, base)
+    media_types = {media: code for code, media in enumerate(base.media_types)}
+    emojis = {emoji: code for code, emoji in enumerate(base.emojis)}
+    user_map = _merge_users(users, user_names, extra)
+    media_map = np.array([ChatStoreBuilder._intern(media_types, media) for media in extra.media_types], dtype=np.int16)
+    emoji_map = np.array([ChatStoreBuilder._intern(emojis, emoji) for emoji in extra.emojis] + [NO_ID], dtype=np.int32)
+    user_ids = list(users)
+
+    added = extra.columns()
+    added["sender"] = _remap(extra.sender, user_map)
+    added["media"] = _remap(extra.media, media_map)
+    added["chat"] = np.zeros(len(extra), dtype=np.int16)
+    added["reaction_emoji"] = _remap(extra.reaction_emoji, emoji_map)
+    added["reactor_emoji"] = _remap(extra.reactor_emoji, emoji_map)
+    added["reactor_user"] = _remap(extra.reactor_user, user_map)
+    meta = meta if meta is not None else base.meta
+    added_store = ChatStore(meta, user_names, list(media_types), list(emojis), added, user_ids=user_ids)
+
+    columns = {name: np.concatenate([getattr(base, name), added[name]]) for name in ChatStore.COLUMNS}
+    for name in ("ids", "reply_to"):
+        columns[name] = compact_ints(columns[name])
+    for name in ("reaction_msg", "reactor_msg"):
+        columns[name][len(getattr(base, name)):] += len(base)
+    new_row = sort_by_time(columns)
+    if new_row is None:
+        new_row = np.arange(len(columns["ts"]))
+
+    appended = {
+        "base": base,
+        "columns": columns,
+        "base_rows": new_row[:len(base)],
+        "added_rows": new_row[len(base):],
+        "aggregates": {},
+    }
+    for name, merge in AGGREGATE_MERGES.items():
+        if name in base.aggregates:
+            appended["aggregates"][name] = merge(base.aggregates[name], added_store.aggregates[name], appended)
+    return ChatStore(meta, user_names, list(media_types), list(emojis), columns, key=key,
+                     aggregates=appended["aggregates"], user_ids=user_ids)
+
+
+def build_store(data, key=None):
+    """Разбирает словарь экспорта Telegram в ChatStore"""
+    builder = ChatStoreBuilder()
+    builder.add_many(data.get("messages", []))
+    return builder.build(chat_meta(data), key=key)
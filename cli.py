@@ -0,0 +1,187 @@
+"""Пакетный запуск встроенных плагинов без Streamlit.
+
+Пример:
+    python cli.py exports/*.json -o results --format csv parquet --png
+
+Для каждого файла экспорта создаётся каталог с таблицами результатов
+каждого плагина: <плагин>.<таблица>.<формат>, и, если указан --png,
+графиком <плагин>.png. Для полного экспорта аккаунта в этом каталоге
+создаётся подкаталог на каждый чат. Файлы обрабатываются параллельно
+в пуле процессов.
+"""
+import argparse
+import csv
+import importlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import ingest
+
+BUILTIN_PLUGINS = [
+    "hourly_activity",
+    "weekly_activity",
+    "activity_by_period",
+    "messages_counter",
+    "radio_silence",
+    "silent_time",
+    "reactions_per_user",
+    "reply_network",
+]
+FORMATS = ("csv", "json", "parquet")
+
+
+def write_csv(path, rows):
+    # Порядок колонок — порядок первого появления ключа в строках
+    fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def write_json(path, rows):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(rows, f, ensure_ascii=False, indent=1, default=str)
+
+
+def write_parquet(path, rows):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    pq.write_table(pa.Table.from_pylist(rows), path)
+
+
+WRITERS = {"csv": write_csv, "json": write_json, "parquet": write_parquet}
+
+
+def export_plugin(module, store, out_dir, formats, png):
+    """Вычисляет результат плагина с параметрами по умолчанию и записывает его"""
+    params = module.default_params(store) if hasattr(module, "default_params") else {}
+    if params is None:
+        return 0
+    result = module.compute(store, params)
+
+    written = 0
+    name = module.__name__
+    for table, rows in module.to_tables(result).items():
+        for fmt in formats:
+            WRITERS[fmt](os.path.join(out_dir, f"{name}.{table}.{fmt}"), rows)
+            written += 1
+    if png and result and hasattr(module, "draw_figure"):
+        module.draw_figure(result).savefig(os.path.join(out_dir, f"{name}.png"))
+        written += 1
+    return written
+
+
+def export_store(store, out_dir, plugin_names, formats, png):
+    """Записывает результаты плагинов для одного чата, возвращает (число файлов, ошибки)"""
+    os.makedirs(out_dir, exist_ok=True)
+    written = 0
+    errors = []
+    for name in plugin_names:
+        try:
+            written += export_plugin(importlib.import_module(name), store, out_dir, formats, png)
+        except Exception as e:
+            errors.append(f"{name}: {e}")
+    return written, errors
+
+
+def account_dirs(out_dir, toc):
+    # Чаты полного экспорта аккаунта раскладываются по подкаталогам с id чата
+    # (чат может быть и в chats, и в left_chats — тогда подкаталоги нумеруются)
+    return output_dirs([str(chat["id"]) if chat["id"] is not None else f"chat_{n}"
+                        for n, chat in enumerate(toc, 1)], out_dir)
+
+
+def process_file(path, out_dir, plugin_names, formats, png):
+    """Обрабатывает один файл экспорта. Выполняется в процессе пула.
+
+    Полный экспорт аккаунта разбивается по оглавлению: каждый чат
+    разбирается и выгружается отдельно, в свой подкаталог out_dir.
+    """
+    started = time.perf_counter()
+    messages = written = 0
+    errors = []
+    with open(path, "rb") as f:
+        if ingest.export_kind(f) == "account":
+            toc = ingest.scan_account(f)
+            chats = [(chat["start"], chat["end"] - chat["start"], chat_dir)
+                     for chat, chat_dir in zip(toc, account_dirs(out_dir, toc))]
+        else:
+            chats = [(0, None, out_dir)]
+        for start, size, chat_dir in chats:
+            store = ingest.stream_store(f, start=start, size=size)
+            chat_written, chat_errors = export_store(store, chat_dir, plugin_names, formats, png)
+            messages += len(store)
+            written += chat_written
+            prefix = "" if chat_dir == out_dir else f"{os.path.basename(chat_dir)}/"
+            errors.extend(prefix + error for error in chat_errors)
+    return {
+        "file": path,
+        "messages": messages,
+        "written": written,
+        "errors": errors,
+        "seconds": time.perf_counter() - started,
+    }
+
+
+def output_dirs(paths, output):
+    # Каталог результата назван по имени файла, одинаковые имена нумеруются
+    dirs = []
+    used = set()
+    for path in paths:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        name, n = stem, 1
+        while name in used:
+            n += 1
+            name = f"{stem}_{n}"
+        used.add(name)
+        dirs.append(os.path.join(output, name))
+    return dirs
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Анализ экспортов Telegram без веб-интерфейса")
+    parser.add_argument("files", nargs="+", help="файлы экспорта в формате JSON")
+    parser.add_argument("-o", "--output", default="results", help="каталог для результатов")
+    parser.add_argument("-p", "--plugins", nargs="+", choices=BUILTIN_PLUGINS, default=BUILTIN_PLUGINS,
+                        help="какие плагины запускать (по умолчанию все)")
+    parser.add_argument("-f", "--format", nargs="+", choices=FORMATS, default=["csv"], dest="formats",
+                        help="форматы таблиц результатов")
+    parser.add_argument("--png", action="store_true", help="сохранять графики в PNG")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="число процессов (по умолчанию — число ядер)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    failed = 0
+
+    with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(args.files)))) as pool:
+        futures = {
+            pool.submit(process_file, path, out_dir, args.plugins, args.formats, args.png): path
+            for path, out_dir in zip(args.files, output_dirs(args.files, args.output))
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            try:
+                report = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"[{done}/{len(futures)}] {path}: ошибка чтения: {e}", file=sys.stderr)
+                continue
+            print(f"[{done}/{len(futures)}] {path}: {report['messages']} сообщений, "
+                  f"файлов: {report['written']}, {report['seconds']:.1f} с")
+            for error in report["errors"]:
+                failed += 1
+                print(f"    ошибка плагина {error}", file=sys.stderr)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+import json
+import os
+import shutil
+import time
+import uuid
+
+import pyarrow as pa
+
+from chat_store import ChatStore
+
+CACHE_DIR = os.environ.get("CHATS_ANALYZER_CACHE_DIR", os.path.join(".cache", "chats"))
+CACHE_LIMIT_BYTES = int(os.environ.get("CHATS_ANALYZER_CACHE_MB", "2048")) * 1024 * 1024
+# Увеличивается при несовместимом изменении формата хранилища
+CACHE_VERSION = 8
+
+META_FILE = "meta.json"
+# Недописанные записи старше этого срока считаются брошенными
+STALE_TMP_SECONDS = 3600
+
+
+def _entry_dir(key):
+    return os.path.join(CACHE_DIR, key)
+
+
+def _write_table(path, columns):
+    table = pa.table({name: pa.array(values) for name, values in columns.items()})
+    with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def _read_table(path):
+    # Файл отображается в память: колонки — read-only представления без копирования,
+    # страницы общие для всех процессов и сессий, открывших тот же файл
+    with pa.memory_map(path, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+    return {name: table.column(name).to_numpy() for name in table.column_names}
+
+
+def save_store(store):
+    """Сохраняет колонки и агрегаты хранилища в файлы Arrow под store.key"""
+    entry = _entry_dir(store.key)
+    if os.path.exists(entry):
+        return
+
+    # Пишем во временный каталог и переименовываем, чтобы другие сессии не увидели запись наполовину
+    tmp_entry = f"{entry}.tmp-{uuid.uuid4().hex}"
+    try:
+        os.makedirs(tmp_entry)
+        for table, columns in store.tables().items():
+            _write_table(os.path.join(tmp_entry, f"{table}.arrow"), columns)
+        for name, columns in store.aggregates.items():
+            _write_table(os.path.join(tmp_entry, f"aggregate_{name}.arrow"), columns)
+        info = {
+            "version": CACHE_VERSION,
+            "meta": store.meta,
+            "users": store.user_names,
+            "user_ids": store.user_ids,
+            "media_types": store.media_types,
+            "emojis": store.emojis,
+            "aggregates": list(store.aggregates),
+            "max_id": int(store.ids.max()) if len(store) else None,
+        }
+        with open(os.path.join(tmp_entry, META_FILE), "w", encoding="utf-8") as f:
+            json.dump(info, f, ensure_ascii=False)
+        os.replace(tmp_entry, entry)
+    except OSError:
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        return
+    evict(keep=store.key)
+
+
+def load_store(key):
+    """Загружает хранилище из кэша или возвращает None"""
+    entry = _entry_dir(key)
+    meta_path = os.path.join(entry, META_FILE)
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            info = json.load(f)
+        if info.get("version") != CACHE_VERSION:
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+        columns = {}
+        for table in ChatStore.TABLES:
+            columns.update(_read_table(os.path.join(entry, f"{table}.arrow")))
+        aggregates = {
+            name: _read_table(os.path.join(entry, f"aggregate_{name}.arrow"))
+            for name in info["aggregates"]
+        }
+        # Время изменения meta.json — отметка последнего использования для вытеснения
+        os.utime(meta_path)
+    except (OSError, ValueError, KeyError):
+        return None
+    return ChatStore(info["meta"], info["users"], info["media_types"], info["emojis"], columns,
+                     key=key, aggregates=aggregates, user_ids=info["user_ids"])
+
+
+def find_chat(chat_id):
+    """Ключ сохранённого хранилища чата chat_id с наибольшим id сообщения или None"""
+    if chat_id is None:
+        return None
+    try:
+        names = os.listdir(CACHE_DIR)
+    except OSError:
+        return None
+
+    best_key, best_max_id = None, None
+    for name in names:
+        if ".tmp-" in name:
+            continue
+        try:
+            with open(os.path.join(_entry_dir(name), META_FILE), encoding="utf-8") as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if info.get("version") != CACHE_VERSION or info["meta"].get("id") != chat_id:
+            continue
+        # Объединённые хранилища (несколько чатов) не подходят
+        if info["meta"].get("chats") or info.get("max_id") is None:
+            continue
+        if best_max_id is None or info["max_id"] > best_max_id:
+            best_key, best_max_id = name, info["max_id"]
+    return best_key
+
+
+def _dir_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def evict(limit=CACHE_LIMIT_BYTES, keep=None):
+    """Удаляет давно не использованные записи, пока кэш занимает больше limit байт"""
+    try:
+        names = os.listdir(CACHE_DIR)
+    except OSError:
+        return
+
+    entries = []
+    now = time.time()
+    for name in names:
+        path = _entry_dir(name)
+        try:
+            if ".tmp-" in name:
+                if now - os.path.getmtime(path) > STALE_TMP_SECONDS:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            entries.append((os.path.getmtime(os.path.join(path, META_FILE)), _dir_size(path), name))
+        except OSError:
+            continue
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= limit:
+            break
+        if name == keep:
+            continue
+        shutil.rmtree(_entry_dir(name), ignore_errors=True)
+        total -= size
@@ -0,0 +1,65 @@
+"""Паузы между сообщениями: векторный расчёт по отсортированным временам.
+
+Все функции работают с массивами numpy и не зависят от Streamlit,
+поэтому ими пользуются и хранилище (сводка chat_gaps), и плагины
+silent_time и radio_silence.
+"""
+import numpy as np
+
+
+def group_gaps(ts, group=None):
+    """Паузы между соседними сообщениями внутри каждой группы (пользователя, чата).
+
+    ts отсортирован по времени. Возвращает (gap, end): длительность паузы в
+    секундах и номер строки сообщения, которым пауза закончилась.
+    """
+    if group is None:
+        order = np.arange(len(ts))
+        same = np.ones(max(len(ts) - 1, 0), dtype=bool)
+    else:
+        # Устойчивая сортировка по группе сохраняет порядок по времени внутри группы
+        order = np.argsort(group, kind="stable")
+        grouped = group[order]
+        same = grouped[1:] == grouped[:-1]
+    gap = np.diff(ts[order])
+    return gap[same], order[1:][same]
+
+
+def descending(gap, end):
+    """Порядок пауз по убыванию длительности, равные — по времени"""
+    return np.lexsort((end, -gap))
+
+
+def count_at_least(sorted_gap, threshold):
+    """Сколько пауз не короче threshold в массиве, отсортированном по убыванию"""
+    return int(np.searchsorted(-sorted_gap, -threshold, side="right"))
+
+
+def top_gaps(gap, k):
+    """Индексы k самых длинных пауз по убыванию: частичный отбор вместо полной сортировки"""
+    if k >= len(gap):
+        return np.argsort(-gap, kind="stable")
+    top = np.argpartition(-gap, k)[:k]
+    return top[np.argsort(-gap[top], kind="stable")]
+
+
+def log2_histogram(gap, group=None, n_groups=1):
+    """Гистограмма пауз по корзинам [2^i, 2^(i+1)) секунд за один проход.
+
+    Паузы короче секунды не учитываются, самая длинная пауза попадает в
+    последнюю корзину. Возвращает (counts, edges): матрицу группа × корзина
+    и границы корзин.
+    """
+    positive = gap >= 1
+    gap = gap[positive]
+    if not len(gap):
+        return np.zeros((n_groups, 0), dtype=np.int64), np.ones(1, dtype=np.int64)
+
+    # frexp точно даёт целую часть log2 без погрешностей округления
+    exponent = np.frexp(gap.astype(np.float64))[1] - 1
+    n_bins = max(int(np.ceil(np.log2(gap.max()))), 1)
+    exponent = np.minimum(exponent, n_bins - 1)
+
+    group = np.zeros(len(gap), dtype=np.int64) if group is None else group[positive].astype(np.int64)
+    counts = np.bincount(group * n_bins + exponent, minlength=n_groups * n_bins)
+    return counts.reshape(n_groups, n_bins), 2 ** np.arange(n_bins + 1, dtype=np.int64)
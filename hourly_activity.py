@@ -1,38 +1,30 @@
-from collections import defaultdict
-from datetime import datetime
 import streamlit as st
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 
+import charts
+from chat_store import build_store, ts_to_date, user_bucket_counts
 
-def parse_date(date_str):
-    return datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S")
+HOUR_LABELS = [(h + 4) % 24 for h in range(24)]
+GROUP_LABELS = {"users": "По пользователям", "chats": "По чатам"}
 
 
-def run_plugin(data):
-    messages = data.get("messages", [])
-    chat_name = data.get("name", "Чат")
+def default_params(store):
+    # По умолчанию анализируется вся история чата
+    if not len(store):
+        return None
+    return {"start_date": ts_to_date(store.ts[0]), "end_date": ts_to_date(store.ts[-1]), "group": "users"}
 
-    if not messages:
-        st.warning("Нет сообщений в чате.")
-        return
 
-    # Парсим даты сообщений
-    for msg in messages:
-        try:
-            dt = parse_date(msg['date'])
-            msg['parsed_date'] = dt
-            msg['date_only'] = dt.date()
-        except Exception:
-            msg['parsed_date'] = None
-            msg['date_only'] = None
-
-    valid_dates = [msg['date_only'] for msg in messages if msg['date_only'] is not None]
-    if not valid_dates:
-        st.warning("Нет валидных дат в сообщениях.")
-        return
+def select_params(store):
+    chat_name = store.name
+
+    defaults = default_params(store)
+    if defaults is None:
+        st.warning("Нет сообщений в чате.")
+        return None
 
-    min_date = min(valid_dates)
-    max_date = max(valid_dates)
+    min_date = defaults["start_date"]
+    max_date = defaults["end_date"]
 
     st.subheader(f"Активность пользователей по часам в чате: {chat_name}")
 
@@ -45,44 +37,87 @@ def run_plugin(data):
 
     if start_date > end_date:
         st.error("Начало анализа не может быть позже конца.")
-        return
+        return None
 
-    # Фильтрация сообщений по дате (включительно)
-    filtered_msgs = [msg for msg in messages if msg['date_only'] is not None and start_date <= msg['date_only'] <= end_date]
+    # В объединённом хранилище можно сравнивать сами чаты, а не пользователей
+    group = defaults["group"]
+    if len(store.chat_names) > 1:
+        group = st.radio("Линии графика", list(GROUP_LABELS), format_func=GROUP_LABELS.get,
+                         horizontal=True, key="hour_group")
 
-    if not filtered_msgs:
-        st.warning("Нет сообщений в выбранном диапазоне дат.")
-        return
+    return {"start_date": start_date, "end_date": end_date, "group": group}
 
-    # Считаем активность по часам сдвиг часа в 4 утра
-    user_hour_counts = defaultdict(lambda: [0]*24)
-
-    for msg in filtered_msgs:
-        try:
-            sender = msg['from']
-            hour = msg['parsed_date'].hour
-            shifted_hour = (hour - 4) % 24
-            user_hour_counts[sender][shifted_hour] += 1
-        except Exception:
-            continue
-
-    if not user_hour_counts:
-        st.warning("Нет данных для построения графика.")
-        return
 
+def compute(store, params):
+    # Фильтрация по дате (включительно): берём ячейки куба активности за выбранные дни
+    cube = store.cube
+    rows = store.cube_slice(params["start_date"], params["end_date"])
+
+    # Считаем активность по часам сдвиг часа в 4 утра
+    shifted_hours = (cube["hour"][rows] - 4) % 24
+    if params.get("group") == "chats":
+        names = store.chat_names
+        series = cube["chat"][rows]
+    else:
+        names = store.users
+        series = cube["user"][rows]
+    counts = user_bucket_counts(series, shifted_hours, 24, len(names), weights=cube["messages"][rows])
+    return {
+        "group": params.get("group", "users"),
+        "counts": {names[code]: counts[code].tolist() for code in counts.any(axis=1).nonzero()[0]},
+    }
+
+
+def to_tables(result):
+    series = "Чат" if result["group"] == "chats" else "Пользователь"
+    rows = [
+        {series: name, "Час": hour, "Сообщений": count}
+        for name, counts in result["counts"].items()
+        for hour, count in zip(HOUR_LABELS, counts)
+    ]
+    return {"hours": rows}
+
+
+def chart_title(result):
+    if result["group"] == "chats":
+        return "Активность чатов по часам суток (начало в 4:00)"
+    return "Активность пользователей по часам суток (начало в 4:00)"
+
+
+def draw_chart(result):
+    data = charts.series_frame(HOUR_LABELS, result["counts"])
+    return charts.line_chart(data, "Час суток", "Количество сообщений", chart_title(result), x_sort=HOUR_LABELS)
+
+
+def draw_figure(result):
     hours = list(range(24))
-    hour_labels = [(h + 4) % 24 for h in hours]
 
-    plt.figure(figsize=(12, 6))
-    for user, counts in user_hour_counts.items():
-        plt.plot(hours, counts, label=user, marker='o')
+    fig = Figure(figsize=(12, 6))
+    ax = fig.subplots()
+    for name, counts in result["counts"].items():
+        ax.plot(hours, counts, label=name, marker='o')
+
+    ax.set_xticks(hours, HOUR_LABELS)
+    ax.set_xlabel("Час суток")
+    ax.set_ylabel("Количество сообщений")
+    ax.set_title(chart_title(result))
+    ax.legend()
+    ax.grid(True)
+    fig.tight_layout()
+    return fig
+
+
+def render(result):
+    if not result["counts"]:
+        st.warning("Нет сообщений в выбранном диапазоне дат.")
+        return
+
+    charts.show(lambda: draw_chart(result), lambda: draw_figure(result))
 
-    plt.xticks(hours, hour_labels)
-    plt.xlabel("Час суток")
-    plt.ylabel("Количество сообщений")
-    plt.title("Активность пользователей по часам суток (начало в 4:00)")
-    plt.legend()
-    plt.grid(True)
-    plt.tight_layout()
 
-    st.pyplot(plt)
+def run_plugin(data, store=None):
+    if store is None:
+        store = build_store(data)
+    params = select_params(store)
+    if params is not None:
+        render(compute(store, params))
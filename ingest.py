@@ -0,0 +1,402 @@
+import hashlib
+import io
+import json
+import re
+
+import numpy as np
+
+from chat_store import ChatStoreBuilder, append_store, build_store, chat_meta, parse_dates
+
+CHUNK_SIZE = 8 * 1024 * 1024
+# Сколько сообщений проверять на «уже разобрано» за раз при дозагрузке
+ID_BATCH_SIZE = 4096
+
+_QUOTE = ord('"')
+_BACKSLASH = ord('\\')
+_OPEN_OBJECT = ord('{')
+_CLOSE_OBJECT = ord('}')
+_OPEN_ARRAY = ord('[')
+_CLOSE_ARRAY = ord(']')
+_FOLD_BRACE = 0xFF ^ 0x20
+
+# +1 для открывающих скобок, -1 для закрывающих, 0 для остальных байтов
+_DEPTH_DELTA = np.zeros(256, dtype=np.int8)
+_DEPTH_DELTA[[ord('{'), ord('[')]] = 1
+_DEPTH_DELTA[[ord('}'), ord(']')]] = -1
+
+_MESSAGES_KEY = re.compile(rb'"messages"\s*:\s*$')
+# id в начале объекта сообщения: по нему старые сообщения пропускаются без json.loads
+_MESSAGE_ID = re.compile(rb'\{\s*"id"\s*:\s*(-?\d+)')
+_KEY_BEFORE = re.compile(rb'"([^"]*)"\s*:\s*$')
+# Сколько байт перед скобкой просматривать в поисках ключа
+KEY_LOOKBEHIND = 64
+
+# Разделы полного экспорта аккаунта со списками чатов
+ACCOUNT_CHAT_SECTIONS = ("chats", "left_chats")
+# Глубина вложенности в полном экспорте: корень -> раздел -> list -> чат -> messages -> сообщение
+_SECTION_DEPTH = 2
+_LIST_DEPTH = 3
+_CHAT_DEPTH = 4
+_MESSAGE_DEPTH = 6
+
+
+def file_hash(fp, chunk_size=CHUNK_SIZE):
+    """Хэш содержимого файла без чтения его целиком в память"""
+    digest = hashlib.md5()
+    fp.seek(0)
+    for chunk in iter(lambda: fp.read(chunk_size), b""):
+        digest.update(chunk)
+    fp.seek(0)
+    return digest.hexdigest()
+
+
+def file_size(fp):
+    position = fp.tell()
+    fp.seek(0, 2)
+    size = fp.tell()
+    fp.seek(position)
+    return size
+
+
+def position_progress(progress, start, size):
+    """Переводит позицию в файле в долю прочитанного для progress(доля) или возвращает None"""
+    if progress is None:
+        return None
+    total = size or 1
+    return lambda position: progress(min((position - start) / total, 1.0))
+
+
+def scan_chunk(buf, in_string=False, escaped=False):
+    """Находит скобки JSON вне строковых литералов в очередном куске файла.
+
+    in_string — кусок начинается внутри строки, escaped — его первый байт
+    экранирован (предыдущий кусок закончился нечётным числом обратных слэшей).
+    Возвращает позиции скобок, глубину вложенности после каждой из них
+    (считая от начала куска) и состояние (in_string, escaped) для следующего куска.
+    """
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    quotes = np.flatnonzero(raw == _QUOTE)
+
+    # Кавычка экранирована, если перед ней нечётное число обратных слэшей.
+    # Такие кавычки редки, поэтому проверяем их в цикле.
+    candidates = quotes[(quotes > 0) & (raw[quotes - 1] == _BACKSLASH)]
+    escaped_quotes = []
+    for pos in candidates.tolist():
+        start = pos - 1
+        while start >= 0 and raw[start] == _BACKSLASH:
+            start -= 1
+        if (pos - 1 - start + (escaped and start < 0)) % 2:
+            escaped_quotes.append(pos)
+    if escaped and len(quotes) and quotes[0] == 0:
+        escaped_quotes.append(0)
+    if escaped_quotes:
+        quotes = np.setdiff1d(quotes, escaped_quotes, assume_unique=True)
+
+    # Без бита 0x20 обе открывающие скобки дают '[', обе закрывающие — ']':
+    # два сравнения по куску быстрее выборки из таблицы _DEPTH_DELTA
+    folded = raw & _FOLD_BRACE
+    brackets = np.flatnonzero((folded == _OPEN_ARRAY) | (folded == _CLOSE_ARRAY))
+    # Скобка внутри строки, если перед ней нечётное число кавычек
+    outside = (np.searchsorted(quotes, brackets) + in_string) % 2 == 0
+    brackets = brackets[outside]
+    depths = np.cumsum(_DEPTH_DELTA[raw[brackets]], dtype=np.int64)
+
+    trailing = 0
+    while trailing < len(raw) and raw[-1 - trailing] == _BACKSLASH:
+        trailing += 1
+    if trailing == len(raw):
+        trailing += escaped
+    return brackets, depths, bool((in_string + len(quotes)) % 2), bool(trailing % 2)
+
+
+def scan_structure(buf):
+    """Находит скобки JSON вне строковых литералов.
+
+    Возвращает позиции скобок в buf и глубину вложенности после каждой из них
+    (считая от начала buf). buf должен начинаться вне строки.
+    """
+    brackets, depths, _, _ = scan_chunk(buf)
+    return brackets, depths
+
+
+def iter_array_objects(fp, buf, depth, progress=None):
+    """Отдаёт объекты массива по одному, читая файл кусками.
+
+    buf — уже прочитанные байты сразу после открывающей скобки массива,
+    depth — глубина вложенности внутри массива. progress(позиция в файле)
+    вызывается после чтения каждого куска.
+    """
+    finished = False
+    while True:
+        brackets, depths = scan_structure(buf)
+        depths += depth
+        chars = np.frombuffer(buf, dtype=np.uint8)[brackets]
+
+        starts = brackets[(chars == _OPEN_OBJECT) & (depths == depth + 1)]
+        ends = brackets[(chars == _CLOSE_OBJECT) & (depths == depth)]
+        closing = brackets[(chars == _CLOSE_ARRAY) & (depths == depth - 1)]
+        if len(closing):
+            # Массив закончился — берём только объекты до его конца
+            starts = starts[starts < closing[0]]
+            ends = ends[ends < closing[0]]
+            finished = True
+
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            yield buf[start:end + 1]
+
+        if finished:
+            return
+
+        if len(starts) > len(ends):
+            buf = buf[starts[len(ends)]:]
+        else:
+            buf = b""
+
+        chunk = fp.read(CHUNK_SIZE)
+        if not chunk:
+            raise ValueError("Неожиданный конец файла внутри массива сообщений")
+        buf += chunk
+        if progress is not None:
+            progress(fp.tell())
+
+
+def read_until_messages(fp, chunk_size=CHUNK_SIZE):
+    """Читает заголовок экспорта до начала массива messages.
+
+    Возвращает метаданные чата (поля до messages) и байты, прочитанные
+    после открывающей скобки массива.
+    """
+    buf = b""
+    scanned = 0
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            raise ValueError("В файле не найден массив messages")
+        buf += chunk
+        brackets, depths = scan_structure(buf)
+        chars = np.frombuffer(buf, dtype=np.uint8)[brackets]
+        # Ищем массив на первом уровне вложенности, перед которым стоит ключ "messages"
+        for pos in brackets[(chars == ord('[')) & (depths == 2) & (brackets >= scanned)].tolist():
+            if _MESSAGES_KEY.search(buf, max(0, pos - 64), pos):
+                meta = json.loads(buf[:pos] + b"[]}")
+                meta.pop("messages", None)
+                return meta, buf[pos + 1:]
+        scanned = len(buf)
+
+
+def stream_store(fp, key=None, progress=None, start=0, size=None):
+    """Строит ChatStore, не загружая весь JSON в память.
+
+    Сообщения разбираются по одному, в памяти остаются только
+    буфер текущего куска файла и компактные колонки хранилища.
+    start и size задают объект чата внутри полного экспорта аккаунта
+    (см. scan_account), по умолчанию читается весь файл.
+    progress(доля) вызывается после каждого прочитанного куска.
+    """
+    report = position_progress(progress, start, size if size is not None else file_size(fp) - start)
+
+    fp.seek(start)
+    meta, buf = read_until_messages(fp)
+    builder = ChatStoreBuilder()
+    for raw_message in iter_array_objects(fp, buf, depth=2, progress=report):
+        builder.add(json.loads(raw_message))
+    if progress is not None:
+        progress(1.0)
+    return builder.build(chat_meta(meta), key=key)
+
+
+def read_chat_meta(fp, start=0):
+    """Метаданные чата (name, type, id) без чтения сообщений"""
+    fp.seek(start)
+    try:
+        meta, _ = read_until_messages(fp, chunk_size=64 * 1024)
+    except ValueError:
+        meta = {}
+    fp.seek(0)
+    return chat_meta(meta)
+
+
+def update_store(fp, base, key=None, progress=None, start=0, size=None):
+    """Дописывает к base только новые сообщения из более свежего экспорта того же чата.
+
+    Сообщения, id которых (взятый регулярным выражением с начала объекта)
+    уже есть в base, пропускаются без разбора JSON. Сообщение с максимальным
+    id в base служит якорем: если его нет в экспорте или у него другое время,
+    экспорт не продолжает base, и функция возвращает None — нужен полный разбор.
+    """
+    if not len(base):
+        return None
+    high_water = int(base.ids.max())
+    anchor_ts = int(base.ts[base.ids == high_water][0])
+    known_ids = np.sort(base.ids)
+
+    report = position_progress(progress, start, size if size is not None else file_size(fp) - start)
+
+    fp.seek(start)
+    meta, buf = read_until_messages(fp)
+    builder = ChatStoreBuilder()
+    anchor_found = False
+    # Проверка «уже есть в base» делается пачками, векторно по known_ids
+    batch_ids, batch_raw = [], []
+
+    def flush():
+        ids = np.array(batch_ids, dtype=np.int64)
+        found = known_ids[np.minimum(np.searchsorted(known_ids, ids), len(known_ids) - 1)] == ids
+        for raw, known in zip(batch_raw, found.tolist()):
+            if not known:
+                builder.add(json.loads(raw))
+        batch_ids.clear()
+        batch_raw.clear()
+
+    for raw_message in iter_array_objects(fp, buf, depth=2, progress=report):
+        match = _MESSAGE_ID.match(raw_message)
+        # Сообщения без id в начале объекта разбираются всегда
+        msg_id = int(match.group(1)) if match is not None else high_water + 1
+        if msg_id == high_water:
+            msg = json.loads(raw_message)
+            anchor_found = parse_dates([msg.get("date")], [msg.get("date_unixtime")])[0] == anchor_ts
+        batch_ids.append(msg_id)
+        batch_raw.append(raw_message)
+        if len(batch_ids) >= ID_BATCH_SIZE:
+            flush()
+    flush()
+    if progress is not None:
+        progress(1.0)
+    if not anchor_found:
+        return None
+    return append_store(base, builder.build(chat_meta(meta)), key=key, meta=chat_meta(meta))
+
+
+def key_before(buf, pos, tail=b""):
+    """Имя ключа JSON перед скобкой в позиции pos (tail — конец предыдущего куска)"""
+    window = buf[max(0, pos - KEY_LOOKBEHIND):pos]
+    if pos < KEY_LOOKBEHIND:
+        window = tail[max(0, len(tail) - (KEY_LOOKBEHIND - pos)):] + window
+    match = _KEY_BEFORE.search(window)
+    return match.group(1).decode("utf-8", "replace") if match else None
+
+
+def export_kind(fp):
+    """Определяет вид экспорта: "chat" — один чат, "account" — весь аккаунт (chats.list)"""
+    buf = b""
+    scanned = 0
+    try:
+        while True:
+            chunk = fp.read(CHUNK_SIZE)
+            if not chunk:
+                return "chat"
+            buf += chunk
+            brackets, depths = scan_structure(buf)
+            for pos in brackets[(depths == 2) & (brackets >= scanned)].tolist():
+                key = key_before(buf, pos)
+                if key == "messages" and buf[pos] == _OPEN_ARRAY:
+                    return "chat"
+                if key == "chats" and buf[pos] == _OPEN_OBJECT:
+                    return "account"
+            scanned = len(buf)
+    finally:
+        fp.seek(0)
+
+
+def scan_account(fp, progress=None):
+    """Строит оглавление полного экспорта аккаунта за один проход по файлу.
+
+    Для каждого чата из chats.list и left_chats.list возвращает словарь:
+    name, type, id, messages (число сообщений), start и end (границы объекта
+    чата в байтах). Сообщения не разбираются: считаются только скобки, а
+    заголовок чата читается отдельно небольшим куском с его начала.
+    progress(доля) вызывается после каждого прочитанного куска.
+    """
+    total = file_size(fp) or 1
+    fp.seek(0)
+    toc = []
+    offset = depth = 0
+    in_string = escaped = False
+    tail = b""
+    in_chat_section = in_chat_list = False
+    chat = None
+    first_message = 0
+
+    while True:
+        buf = fp.read(CHUNK_SIZE)
+        if not buf:
+            break
+        brackets, depths, in_string, escaped = scan_chunk(buf, in_string, escaped)
+        depths += depth
+        chars = np.frombuffer(buf, dtype=np.uint8)[brackets]
+        message_starts = brackets[(chars == _OPEN_OBJECT) & (depths == _MESSAGE_DEPTH)]
+
+        # Скобки верхних уровней редки, их разбираем в цикле
+        events = (depths <= _LIST_DEPTH) | ((chars == _OPEN_OBJECT) & (depths == _CHAT_DEPTH))
+        for pos, char, level in zip(brackets[events].tolist(), chars[events].tolist(), depths[events].tolist()):
+            if char == _OPEN_OBJECT and level == _SECTION_DEPTH:
+                in_chat_section = key_before(buf, pos, tail) in ACCOUNT_CHAT_SECTIONS
+            elif level < _SECTION_DEPTH:
+                in_chat_section = in_chat_list = False
+            elif char == _OPEN_ARRAY and level == _LIST_DEPTH:
+                in_chat_list = in_chat_section and key_before(buf, pos, tail) == "list"
+            elif level < _LIST_DEPTH:
+                in_chat_list = False
+            elif char == _OPEN_OBJECT and level == _CHAT_DEPTH and in_chat_list:
+                chat = {"start": offset + pos, "messages": 0}
+                first_message = int(np.searchsorted(message_starts, pos))
+            elif char == _CLOSE_OBJECT and level == _LIST_DEPTH and chat is not None:
+                chat["messages"] += int(np.searchsorted(message_starts, pos)) - first_message
+                chat["end"] = offset + pos + 1
+                toc.append(chat)
+                chat = None
+
+        # Чат продолжается в следующем куске
+        if chat is not None:
+            chat["messages"] += len(message_starts) - first_message
+            first_message = 0
+
+        if len(depths):
+            depth = int(depths[-1])
+        offset += len(buf)
+        tail = (tail + buf)[-KEY_LOOKBEHIND:]
+        if progress is not None:
+            progress(min(offset / total, 1.0))
+
+    for chat in toc:
+        fp.seek(chat["start"])
+        try:
+            meta, _ = read_until_messages(fp, chunk_size=64 * 1024)
+        except ValueError:
+            meta = {}
+        chat.update(chat_meta(meta))
+    fp.seek(0)
+    return toc
+
+
+def read_account_chat(fp, entry):
+    """Разбирает один чат полного экспорта в словарь, как у экспорта одного чата"""
+    fp.seek(entry["start"])
+    return json.loads(fp.read(entry["end"] - entry["start"]))
+
+
+def require_chat_export(fp):
+    """ValueError, если в файле полный экспорт аккаунта: его чаты разбираются по оглавлению (scan_account)"""
+    if export_kind(fp) == "account":
+        raise ValueError("это полный экспорт аккаунта, а не одного чата: выберите чат из него отдельно")
+
+
+def ingest_bytes(raw, key=None, streaming=False):
+    """Строит ChatStore из содержимого файла экспорта одного чата.
+
+    Функция уровня модуля, чтобы её можно было выполнять в пуле процессов.
+    """
+    fp = io.BytesIO(raw)
+    require_chat_export(fp)
+    if streaming:
+        return stream_store(fp, key=key)
+    return build_store(json.loads(raw), key=key)
+
+
+def ingest_path(path, key=None, streaming=False):
+    """Как ingest_bytes, но файл читается с диска: в пул процессов передаётся только путь"""
+    with open(path, "rb") as fp:
+        require_chat_export(fp)
+        if streaming:
+            return stream_store(fp, key=key)
+        return build_store(json.load(fp), key=key)
@@ -1,15 +1,40 @@
-import base64
+import cProfile
 import hashlib
-import importlib.util
+import inspect
 import json
+import multiprocessing
 import os
 import sys
-import tempfile
+import threading
+import types
 import io
+import weakref
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+import charts
+import chat_store
+import disk_cache
+import ingest
+import plugin_stats
 
 video_path = "instruction.mp4"
 
+# Сколько разобранных диалогов, не открытых ни в одной сессии, держать в памяти процесса
+MAX_LOADED_CHATS = 8
+# Пункт списка диалогов для анализа всех чатов вместе
+ALL_CHATS = "Все чаты вместе"
+# Сколько результатов compute плагинов держать в памяти процесса
+MAX_PLUGIN_RESULTS = 128
+# Сколько плагинов вычислять одновременно
+PLUGIN_WORKERS = min(8, os.cpu_count() or 1)
+# Каталог на сервере с файлами экспорта, которые можно выбрать без загрузки через браузер
+DATA_DIR = os.environ.get("CHATS_ANALYZER_DATA_DIR")
+
 predefined_plugin_paths = [
     "hourly_activity.py",
     "messages_counter.py",
@@ -27,6 +52,297 @@ def create_uploaded_file_from_path(path):
     bytes_io.name = os.path.basename(path)
     return bytes_io
 
+
+class ServerFile(io.BufferedReader):
+    """Файл экспорта из DATA_DIR с интерфейсом загруженного файла.
+
+    В отличие от st.file_uploader, который держит файл в памяти целиком,
+    читается с диска по мере надобности.
+    """
+
+    def __init__(self, path):
+        super().__init__(io.FileIO(path, "rb"))
+        self.path = path
+        stat = os.stat(path)
+        # Изменённый на диске файл получает новый ключ и хэшируется заново
+        self.file_id = f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+
+def server_files():
+    """Имена файлов JSON в DATA_DIR"""
+    if not DATA_DIR or not os.path.isdir(DATA_DIR):
+        return []
+    return sorted(name for name in os.listdir(DATA_DIR) if name.endswith(".json"))
+
+
+def get_file_hash(file):
+    # Хэш содержимого считаем один раз на каждый загруженный файл
+    file_hashes = st.session_state.setdefault("file_hashes", {})
+    file_key = getattr(file, "file_id", file.name)
+    if file_key not in file_hashes:
+        file_hashes[file_key] = ingest.file_hash(file)
+    return file_hashes[file_key]
+
+
+@st.cache_resource
+def instruction_video():
+    # Видео инструкции читается с диска один раз на процесс
+    with open(video_path, "rb") as f:
+        return f.read()
+
+
+@st.cache_resource
+def loaded_chats():
+    # Разобранные диалоги общие для всех сессий: хэш файла -> {"store": ..., "data": ...}
+    return OrderedDict()
+
+
+@st.cache_resource
+def chat_refs():
+    # Сколько сессий сейчас показывают диалог: хэш -> число сессий.
+    # Замок защищает и счётчики, и loaded_chats; он повторно входимый, потому что
+    # weakref.finalize может отпустить диалоги в потоке, который уже держит замок.
+    return {"counts": Counter(), "lock": threading.RLock()}
+
+
+class ChatLease:
+    """Диалоги, открытые в сессии. Лежит в session_state: когда сессия
+    удаляется, weakref.finalize отпускает её ссылки на диалоги."""
+
+    def __init__(self):
+        self.keys = set()
+
+
+@st.cache_resource
+def plugin_results():
+    # Результаты compute общие для всех сессий: (хэш плагина, хэш диалога, параметры) -> результат
+    return {"results": OrderedDict(), "lock": threading.Lock()}
+
+
+def load_chat(file, streaming=False, entry=None):
+    """Возвращает хранилище диалога из памяти, дискового кэша или после разбора файла.
+
+    entry — чат из оглавления полного экспорта аккаунта (см. load_account_toc):
+    тогда разбирается только его объект внутри файла.
+    """
+    chat_key = get_file_hash(file)
+    if entry is not None:
+        chat_key = hashlib.md5(f"{chat_key}:{entry['start']}".encode()).hexdigest()
+    chat = cached_chat(chat_key)
+    if chat is not None:
+        return chat
+
+    chat = {"store": disk_cache.load_store(chat_key), "data": None}
+    if chat["store"] is None:
+        start, size = (entry["start"], entry["end"] - entry["start"]) if entry is not None else (0, None)
+        chat["store"] = update_previous_export(file, chat_key, entry)
+        if chat["store"] is None and streaming:
+            # Сообщения читаются по одному, словарь со всеми сообщениями не создаётся
+            file.seek(0)
+            progress_bar = st.sidebar.progress(0.0, text="Чтение диалога...")
+            chat["store"] = ingest.stream_store(
+                file, key=chat_key, start=start, size=size,
+                progress=lambda done: progress_bar.progress(done, text=f"Чтение диалога: {done:.0%}")
+            )
+            progress_bar.empty()
+        elif chat["store"] is None:
+            with st.spinner("Обработка диалога..."):
+                chat["data"] = read_chat_data(file, entry)
+                chat["store"] = chat_store.build_store(chat["data"], key=chat_key)
+        chat["store"] = shared_store(chat["store"])
+
+    remember_chat(chat_key, chat)
+    return chat
+
+
+def shared_store(store):
+    """Сохраняет хранилище в дисковый кэш и возвращает его копию, отображённую в память.
+
+    Колонки отображённого хранилища лежат в page cache ОС, а не в куче
+    процесса, и общие для всех, кто открыл те же файлы.
+    """
+    disk_cache.save_store(store)
+    return disk_cache.load_store(store.key) or store
+
+
+def update_previous_export(file, chat_key, entry=None):
+    """Дописывает новые сообщения к хранилищу того же чата (по id) из более раннего экспорта.
+
+    Возвращает None, если такого хранилища нет или файл его не продолжает.
+    """
+    chat_id = entry["id"] if entry is not None else ingest.read_chat_meta(file)["id"]
+    base_key = disk_cache.find_chat(chat_id)
+    base = disk_cache.load_store(base_key) if base_key is not None else None
+    if base is None:
+        return None
+
+    start, size = (entry["start"], entry["end"] - entry["start"]) if entry is not None else (0, None)
+    progress_bar = st.sidebar.progress(0.0, text="Поиск новых сообщений...")
+    store = ingest.update_store(
+        file, base, key=chat_key, start=start, size=size,
+        progress=lambda done: progress_bar.progress(done, text=f"Поиск новых сообщений: {done:.0%}")
+    )
+    progress_bar.empty()
+    return store
+
+
+def read_chat_data(file, entry=None):
+    file.seek(0)
+    if entry is not None:
+        return ingest.read_account_chat(file, entry)
+    return json.load(file)
+
+
+@st.cache_resource
+def account_tocs():
+    # Оглавления полных экспортов: хэш файла -> список чатов (None для экспорта одного чата)
+    return {}
+
+
+def load_account_toc(file):
+    """Оглавление полного экспорта аккаунта или None, если в файле один чат"""
+    tocs = account_tocs()
+    file_hash = get_file_hash(file)
+    if file_hash not in tocs:
+        if ingest.export_kind(file) == "account":
+            progress_bar = st.sidebar.progress(0.0, text="Поиск чатов в архиве...")
+            tocs[file_hash] = ingest.scan_account(
+                file, progress=lambda done: progress_bar.progress(done, text=f"Поиск чатов в архиве: {done:.0%}")
+            )
+            progress_bar.empty()
+        else:
+            tocs[file_hash] = None
+    return tocs[file_hash]
+
+
+def cached_chat(chat_key):
+    """Диалог из памяти процесса или None; найденный отмечается как недавно использованный"""
+    chats, refs = loaded_chats(), chat_refs()
+    with refs["lock"]:
+        chat = chats.get(chat_key)
+        if chat is not None:
+            chats.move_to_end(chat_key)
+    return chat
+
+
+def remember_chat(chat_key, chat, limit=MAX_LOADED_CHATS):
+    chats, refs = loaded_chats(), chat_refs()
+    with refs["lock"]:
+        chats[chat_key] = chat
+        chats.move_to_end(chat_key)
+    trim_chats(chats, refs, limit)
+
+
+def trim_chats(chats, refs, limit=MAX_LOADED_CHATS):
+    # Вытесняются только давно не использованные диалоги, которые не открыты ни в одной сессии
+    with refs["lock"]:
+        idle = [chat_key for chat_key in list(chats) if not refs["counts"][chat_key]]
+        for chat_key in idle[:max(0, len(idle) - limit)]:
+            chats.pop(chat_key, None)
+
+
+def release_chats(chat_keys, chats, refs):
+    with refs["lock"]:
+        for chat_key in chat_keys:
+            refs["counts"][chat_key] -= 1
+            if refs["counts"][chat_key] <= 0:
+                del refs["counts"][chat_key]
+    trim_chats(chats, refs)
+
+
+def hold_chats(chat_keys):
+    """Отмечает диалоги, открытые в текущей сессии, и отпускает открытые в ней раньше"""
+    chats, refs = loaded_chats(), chat_refs()
+    lease = st.session_state.get("chat_lease")
+    if lease is None:
+        lease = st.session_state["chat_lease"] = ChatLease()
+        weakref.finalize(lease, release_chats, lease.keys, chats, refs)
+
+    chat_keys = set(chat_keys)
+    released = lease.keys - chat_keys
+    with refs["lock"]:
+        refs["counts"].update(chat_keys - lease.keys)
+    lease.keys.difference_update(released)
+    lease.keys.update(chat_keys)
+    release_chats(released, chats, refs)
+
+
+def chat_labels(files, stores):
+    # Одинаковые названия чатов (например, два экспорта одного чата) различаем по имени файла
+    names = [store.name for store in stores]
+    return [f"{name} ({file.name})" if names.count(name) > 1 else name
+            for name, file in zip(names, files)]
+
+
+def load_all_chats(files, streaming=False):
+    """Загружает все диалоги и объединяет их в одно хранилище с колонкой chat.
+
+    Диалоги, которых нет ни в памяти, ни в дисковом кэше, разбираются
+    параллельно в пуле процессов. Отдельные хранилища остаются в памяти,
+    поэтому переключение на любой из чатов после этого мгновенное.
+    """
+    files = list({get_file_hash(file): file for file in files}.items())
+    combined_key = hashlib.md5(",".join(file_hash for file_hash, _ in files).encode()).hexdigest()
+    limit = max(MAX_LOADED_CHATS, len(files) + 1)
+    chat = cached_chat(combined_key)
+    if chat is not None:
+        return chat
+
+    for _, file in files:
+        if ingest.export_kind(file) == "account":
+            raise ValueError(f"{file.name} — полный экспорт аккаунта, его чаты можно анализировать только по одному")
+
+    # Хранилища собираются здесь же: другая сессия может вытеснить их из loaded_chats
+    stores = {}
+    missing = []
+    for file_hash, file in files:
+        chat = cached_chat(file_hash)
+        store = chat["store"] if chat is not None else disk_cache.load_store(file_hash)
+        if store is None:
+            missing.append((file_hash, file))
+        else:
+            stores[file_hash] = store
+            if chat is None:
+                remember_chat(file_hash, {"store": store, "data": None}, limit)
+
+    if missing:
+        progress_bar = st.sidebar.progress(0.0, text="Чтение диалогов...")
+        # spawn: процесс сервера многопоточный, fork в нём небезопасен
+        with ProcessPoolExecutor(max_workers=min(len(missing), os.cpu_count() or 1),
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+            # Файл с диска процесс читает сам, загруженный передаётся ему копией байтов
+            futures = {
+                pool.submit(ingest.ingest_path, file.path, file_hash, streaming) if isinstance(file, ServerFile)
+                else pool.submit(ingest.ingest_bytes, file.getvalue(), file_hash, streaming): file_hash
+                for file_hash, file in missing
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                store = stores[futures[future]] = shared_store(future.result())
+                remember_chat(futures[future], {"store": store, "data": None}, limit)
+                progress_bar.progress(done / len(futures), text=f"Прочитано диалогов: {done} из {len(futures)}")
+        progress_bar.empty()
+
+    stores = [stores[file_hash] for file_hash, _ in files]
+    with st.spinner("Объединение диалогов..."):
+        combined = chat_store.combine_stores(stores, key=combined_key,
+                                             names=chat_labels([file for _, file in files], stores))
+    chat = {"store": shared_store(combined), "data": None}
+    remember_chat(combined_key, chat, limit)
+    return chat
+
+
+def load_chat_data(file, chat, entry=None):
+    # Исходный JSON нужен только сторонним плагинам без поддержки хранилища
+    if chat["data"] is None:
+        with st.spinner("Чтение исходного JSON..."):
+            chat["data"] = read_chat_data(file, entry)
+    return chat["data"]
+
+
 st.set_page_config(page_title="Анализатор чатов", layout="wide")
 
 with st.sidebar.expander("Загрузка чатов"):
@@ -39,6 +355,23 @@ with st.sidebar.expander("Загрузка чатов"):
     )
     if uploaded_chats and not isinstance(uploaded_chats, list):
         uploaded_chats = [uploaded_chats]
+    data_files = server_files()
+    if data_files:
+        server_names = st.multiselect(
+            "Файлы на сервере", data_files,
+            help="Файлы из каталога CHATS_ANALYZER_DATA_DIR читаются с диска, "
+                 "без загрузки через браузер и без ограничения на размер."
+        )
+        uploaded_chats = (uploaded_chats or []) + [ServerFile(os.path.join(DATA_DIR, name)) for name in server_names]
+    streaming_mode = st.checkbox(
+        "Потоковая загрузка",
+        help="Для больших файлов: сообщения читаются по одному, расходуется меньше памяти. "
+             "Сторонние плагины без поддержки хранилища в этом режиме не получают сообщения."
+    )
+    combine_mode = st.checkbox(
+        "Все чаты вместе",
+        help="Загрузить все диалоги сразу и добавить вариант анализа всех чатов вместе."
+    )
 
 with st.sidebar.expander("Плагины"):
     uploaded_plugins = st.file_uploader(
@@ -51,6 +384,11 @@ with st.sidebar.expander("Плагины"):
     if uploaded_plugins and not isinstance(uploaded_plugins, list):
         uploaded_plugins = [uploaded_plugins]
 
+st.sidebar.toggle(
+    "Интерактивные графики", value=True, key=charts.INTERACTIVE_KEY,
+    help="Графики рисует браузер: с подсказками и масштабированием. Если выключить, показываются картинки."
+)
+
 for path in predefined_plugin_paths:
         if os.path.exists(path):
             uploaded_plugins.append(create_uploaded_file_from_path(path))
@@ -58,11 +396,22 @@ for path in predefined_plugin_paths:
 st.sidebar.title("Диалоги для анализа")
 selected_file = None
 data = None
+store = None
+load_data = None
 
 if uploaded_chats:
     file_names = [file.name for file in uploaded_chats]
+    if combine_mode and len(uploaded_chats) > 1:
+        file_names = [ALL_CHATS] + file_names
     selected_name = st.sidebar.selectbox("Выберите файл для анализа", file_names)
 
+    if selected_name == ALL_CHATS:
+        try:
+            store = load_all_chats(uploaded_chats, streaming_mode)["store"]
+            data = dict(store.meta)
+        except Exception as e:
+            st.sidebar.error(f"Ошибка загрузки JSON: {e}")
+
     for file in uploaded_chats:
         if file.name == selected_name:
             selected_file = file
@@ -70,69 +419,232 @@ if uploaded_chats:
 
     if selected_file:
         try:
-            data = json.load(selected_file)
+            # В полном экспорте аккаунта сначала выбираем чат по оглавлению
+            entry = None
+            toc = load_account_toc(selected_file)
+            if toc is not None:
+                entry = st.sidebar.selectbox(
+                    "Чат из архива", toc,
+                    format_func=lambda chat_entry: f"{chat_entry['name'] or 'Без названия'} ({chat_entry['messages']} сообщ.)"
+                )
+            if toc is None or entry is not None:
+                chat = load_chat(selected_file, streaming_mode, entry)
+                store = chat["store"]
+                data = chat["data"] or dict(store.meta)
+                if not streaming_mode:
+                    load_data = partial(load_chat_data, selected_file, chat, entry)
         except Exception as e:
             st.sidebar.error(f"Ошибка загрузки JSON: {e}")
+    # Диалог остаётся в памяти процесса, пока открыт хотя бы в одной сессии
+    hold_chats([store.key] if store is not None else [])
 else:
+    hold_chats([])
     st.sidebar.warning("Сначала загрузите файл с диалогом.")
     st.title("Анализ сообщений в telegram")
-    with open(video_path, "rb") as f:
-        video_bytes = f.read()
-        video_base64 = base64.b64encode(video_bytes).decode()
-
-    # HTML с autoplay, loop и controls
-    video_html = f"""
-        <video width="100%" autoplay loop muted controls>
-            <source src="data:video/mp4;base64,{video_base64}" type="video/mp4">
-            Ваш браузер не поддерживает тег <code>video</code>.
-        </video>
-    """
+    # Видео отдаётся медиасервером Streamlit по отдельному URL с поддержкой Range,
+    # а не встраивается в страницу в base64
+    st.video(instruction_video(), autoplay=True, loop=True, muted=True)
 
-    st.markdown(video_html, unsafe_allow_html=True)
 
+def get_module_name(plugin_name: str, plugin_hash: str) -> str:
+    # Имя модуля определяется содержимым плагина, а не путём к файлу
+    plugin_name = os.path.basename(plugin_name).replace(".py", "")
+    return f"plugin_{plugin_name}_{plugin_hash[:8]}"
 
-def get_module_name_from_path(plugin_path: str) -> str:
-    # Создаём уникальное имя на основе пути
-    plugin_name = os.path.basename(plugin_path).replace(".py", "")
-    plugin_hash = hashlib.md5(plugin_path.encode()).hexdigest()[:8]
-    return f"plugin_{plugin_name}_{plugin_hash}"
 
+def accepts_store(func) -> bool:
+    # Плагины с двумя параметрами получают общее хранилище сообщений вторым аргументом
+    try:
+        return len(inspect.signature(func).parameters) >= 2
+    except (TypeError, ValueError):
+        return False
 
-def load_and_run_plugin(plugin_path: str, data, function_name="run_plugin"):
-    module_name = get_module_name_from_path(plugin_path)
 
-    # Проверяем, не загружен ли модуль уже
-    if module_name in sys.modules:
-        plugin_module = sys.modules[module_name]
-    else:
-        spec = importlib.util.spec_from_file_location(module_name, plugin_path)
-        if spec is None:
-            st.error("Не удалось создать спецификацию плагина.")
-            return
-        plugin_module = importlib.util.module_from_spec(spec)
-        sys.modules[module_name] = plugin_module
-        try:
-            spec.loader.exec_module(plugin_module)
-        except Exception as e:
-            st.error(f"Ошибка при загрузке модуля: {e}")
-            return
+@st.cache_resource
+def plugin_registry():
+    # Модули плагинов общие для всех сессий: хэш исходника -> модуль
+    return {}
+
+
+def load_plugin(plugin_name: str, source: bytes, plugin_hash: str):
+    """Загружает плагин из исходника один раз на процесс сервера"""
+    registry = plugin_registry()
+    if plugin_hash in registry:
+        return registry[plugin_hash]
+
+    module_name = get_module_name(plugin_name, plugin_hash)
+    plugin_module = types.ModuleType(module_name)
+    # Модуль регистрируется в sys.modules на время выполнения, как при обычном импорте
+    sys.modules[module_name] = plugin_module
+    try:
+        exec(compile(source, f"<плагин {plugin_name}>", "exec"), plugin_module.__dict__)
+    except Exception as e:
+        sys.modules.pop(module_name, None)
+        st.error(f"Ошибка при загрузке модуля: {e}")
+        return None
+    registry[plugin_hash] = plugin_module
+    return plugin_module
+
 
+def run_legacy_plugin(plugin_module, data, store=None, load_data=None, function_name="run_plugin"):
     if hasattr(plugin_module, function_name):
         func = getattr(plugin_module, function_name)
         try:
-            func(data)
+            if store is not None and accepts_store(func):
+                func(data, store)
+            elif "messages" in data:
+                func(data)
+            elif load_data is not None:
+                func(load_data())
+            else:
+                st.warning("Плагин работает только с исходным JSON. Отключите потоковую загрузку.")
         except Exception as e:
             st.error(f"Ошибка при выполнении плагина: {e}")
     else:
         st.error(f"Функция {function_name} не найдена в плагине")
 
 
+def has_split_api(plugin_module) -> bool:
+    # Плагин с compute/render можно вычислять вне главного потока
+    return callable(getattr(plugin_module, "compute", None)) and callable(getattr(plugin_module, "render", None))
+
+
+def select_plugin_params(plugin_module, store):
+    """Рисует виджеты плагина и возвращает параметры, None — вычислять нечего"""
+    if not hasattr(plugin_module, "select_params"):
+        return {}
+    try:
+        return plugin_module.select_params(store)
+    except Exception as e:
+        st.error(f"Ошибка при выполнении плагина: {e}")
+        return None
+
+
+def params_key(params) -> str:
+    # Параметры приходят из виджетов: числа, строки, даты и списки
+    return json.dumps(params, sort_keys=True, default=str, ensure_ascii=False)
+
+
+def cached_result(key):
+    """Запомненный результат compute как выполненный Future или None"""
+    cache = plugin_results()
+    with cache["lock"]:
+        if key not in cache["results"]:
+            return None
+        cache["results"].move_to_end(key)
+        result = cache["results"][key]
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def remember_result(key, result):
+    cache = plugin_results()
+    with cache["lock"]:
+        results = cache["results"]
+        results[key] = result
+        results.move_to_end(key)
+        while len(results) > MAX_PLUGIN_RESULTS:
+            results.popitem(last=False)
+
+
+def run_plugins(plugins, data, store, load_data=None, profiled=None, trace_memory=False):
+    """Выполняет плагины в три этапа.
+
+    1. select_params — виджеты параметров, по порядку в главном потоке;
+    2. compute(store, params) — вычисления, параллельно в пуле потоков над общим
+       хранилищем (оно только читается, поэтому потоки, а не процессы).
+       Результат запоминается по (хэш плагина, хэш диалога, параметры), так что
+       перезапуск скрипта из-за другого виджета не пересчитывает его заново;
+    3. render(result) — вывод результатов, по порядку в главном потоке; построенные
+       графики кэшируются по тому же ключу (см. charts.render_scope).
+    Плагины только с run_plugin выполняются на этапе вывода, как раньше.
+
+    Каждый этап замеряется (см. plugin_stats), возвращается список записей;
+    память — только с trace_memory. Плагин с именем profiled выполняется
+    под cProfile, без кэша результатов.
+    """
+    ctx = get_script_run_ctx()
+    pool = ThreadPoolExecutor(max_workers=PLUGIN_WORKERS, initializer=add_script_run_ctx, initargs=(None, ctx))
+    records = []
+    try:
+        jobs = []
+        for plugin_name, source in plugins:
+            plugin_hash = hashlib.md5(source).hexdigest()
+            record = plugin_stats.new_record(plugin_name, plugin_hash, store)
+            records.append(record)
+            profiles = (cProfile.Profile(), cProfile.Profile()) if plugin_name == profiled else (None, None)
+            container = st.container()
+            with container:
+                st.subheader(f"Плагин: {plugin_name}")
+                with plugin_stats.measure(record, "load", trace_memory=trace_memory):
+                    plugin_module = load_plugin(plugin_name, source, plugin_hash)
+                if plugin_module is None:
+                    record["error"] = "load"
+                    continue
+                if not has_split_api(plugin_module):
+                    jobs.append((container, plugin_module, None, None, record, profiles))
+                    continue
+                with plugin_stats.measure(record, "select", trace_memory=trace_memory):
+                    params = select_plugin_params(plugin_module, store)
+                if params is None:
+                    continue
+                key = (plugin_hash, store.key, params_key(params))
+                future = cached_result(key) if profiles[0] is None else None
+                if future is not None:
+                    record["cached"] = True
+                else:
+                    future = pool.submit(plugin_stats.timed(plugin_module.compute, record, "compute", profiles[0], trace_memory),
+                                         store, params)
+                jobs.append((container, plugin_module, key, future, record, profiles))
+
+        for container, plugin_module, key, future, record, profiles in jobs:
+            with container:
+                if future is None:
+                    with plugin_stats.measure(record, "render", profiles[1], trace_memory):
+                        run_legacy_plugin(plugin_module, data, store, load_data)
+                    show_profile(*profiles)
+                    continue
+                try:
+                    result = future.result()
+                except Exception as e:
+                    record["error"] = str(e)
+                    st.error(f"Ошибка при выполнении плагина: {e}")
+                    continue
+                remember_result(key, result)
+                try:
+                    # Графики плагина кэшируются по тем же ключам, что и результат compute
+                    # (кроме профилируемого запуска: в профиль должна попасть отрисовка)
+                    render_key = key if profiles[1] is None else None
+                    with plugin_stats.measure(record, "render", profiles[1], trace_memory), charts.render_scope(render_key):
+                        plugin_module.render(result)
+                except Exception as e:
+                    record["error"] = str(e)
+                    st.error(f"Ошибка при выполнении плагина: {e}")
+                show_profile(*profiles)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        for record in records:
+            plugin_stats.finish(record)
+    return records
+
+
+def show_profile(*profiles):
+    text = plugin_stats.profile_text(*profiles)
+    if text:
+        with st.expander("Профиль cProfile"):
+            st.code(text)
+
+
 if uploaded_plugins and data:
-    for plugin in uploaded_plugins:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".py") as tmp_file:
-            tmp_file.write(plugin.read())
-            tmp_file_path = tmp_file.name
-        st.subheader(f"Плагин: {plugin.name}")
-        load_and_run_plugin(tmp_file_path, data)
+    plugins = [(plugin.name, plugin.getvalue()) for plugin in uploaded_plugins]
+    stats_panel = st.sidebar.expander("Замеры плагинов")
+    profiled = stats_panel.selectbox("Подробный профиль (cProfile)", [None] + [name for name, _ in plugins],
+                                     format_func=lambda name: name or "нет")
+    trace_memory = stats_panel.toggle(
+        "Замерять память (tracemalloc)",
+        help="Пик памяти по этапам плагинов. Пока идут замеры, медленнее работают все сессии сервера."
+    )
+    plugin_stats.show_records(stats_panel, run_plugins(plugins, data, store, load_data, profiled, trace_memory))
 elif uploaded_plugins and not data:
     st.warning("Вы загрузили плагин, но не выбрали диалог.")
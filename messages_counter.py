@@ -1,19 +1,55 @@
-from collections import defaultdict
-
 import streamlit as st
+import pandas as pd
+
+from chat_store import build_store, user_bucket_counts
+
+
+def compute(store, params):
+    if not len(store):
+        return None
+    total = [(user, c) for user, c in zip(store.users, store.user_totals["messages"].tolist()) if c]
+
+    # Для объединённого хранилища — ещё и разбивка по чатам (из куба активности)
+    by_chat = {}
+    chat_names = store.chat_names
+    if len(chat_names) > 1:
+        cube = store.cube
+        counts = user_bucket_counts(cube["chat"], cube["user"], len(store.users), len(chat_names),
+                                    weights=cube["messages"])
+        for chat_name, chat_counts in zip(chat_names, counts.tolist()):
+            by_chat[chat_name] = [(user, c) for user, c in zip(store.users, chat_counts) if c]
+    return {"total": total, "by_chat": by_chat}
+
 
+def to_tables(counts):
+    if counts is None:
+        return {"messages": []}
+    tables = {"messages": [{"Пользователь": user, "Сообщений": c} for user, c in counts["total"]]}
+    if counts["by_chat"]:
+        tables["by_chat"] = [
+            {"Чат": chat_name, "Пользователь": user, "Сообщений": c}
+            for chat_name, chat_counts in counts["by_chat"].items()
+            for user, c in chat_counts
+        ]
+    return tables
 
-def run_plugin(data):
-    messages = data.get("messages", [])
-    if not messages:
+
+def render(counts):
+    if counts is None:
         st.warning("Нет сообщений в чате.")
         return
 
-    count = defaultdict(int)
-    for msg in messages:
-        if 'from' in msg:
-            count[msg['from']] += 1
-
     st.write("### Количество сообщений по пользователям")
-    for user, c in count.items():
+    for user, c in counts["total"]:
         st.write(f"**{user}**: {c} сообщений")
+
+    if counts["by_chat"]:
+        st.write("### По чатам")
+        table = pd.DataFrame({chat_name: dict(chat_counts) for chat_name, chat_counts in counts["by_chat"].items()})
+        st.dataframe(table.fillna(0).astype(int))
+
+
+def run_plugin(data, store=None):
+    if store is None:
+        store = build_store(data)
+    render(compute(store, {}))
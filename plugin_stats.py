@@ -0,0 +1,169 @@
+"""Замеры выполнения плагинов: время этапов, пик выделенной памяти, размер входа.
+
+Записи последних запусков хранятся в памяти процесса, показываются в
+боковой панели и выгружаются в JSON Lines. Если задана переменная
+окружения CHATS_ANALYZER_STATS_FILE, каждая запись дописывается в этот файл.
+"""
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+import streamlit as st
+
+STATS_FILE = os.environ.get("CHATS_ANALYZER_STATS_FILE")
+# Сколько записей держать в памяти процесса
+MAX_RECORDS = 1000
+# Сколько строк профиля cProfile показывать
+PROFILE_LINES = 30
+STAGES = ("load", "select", "compute", "render")
+
+
+# Идущие сейчас замеры памяти: у каждого память в начале и пик за время замера.
+# tracemalloc включается на время замеров и выключается после последнего; он
+# замедляет все потоки процесса в разы, поэтому память замеряется только по запросу.
+_memory_stages = []
+_memory_lock = threading.Lock()
+_memory_tracing = {"ours": False}
+
+
+def _fold_peak():
+    # Пик с последнего сброса засчитывается всем идущим замерам, до того как его сбросят
+    peak = tracemalloc.get_traced_memory()[1]
+    for stage in _memory_stages:
+        stage["peak"] = max(stage["peak"], peak)
+
+
+def start_memory():
+    with _memory_lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _memory_tracing["ours"] = True
+        _fold_peak()
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        stage = {"start": current, "peak": current}
+        _memory_stages.append(stage)
+    return stage
+
+
+def stop_memory(stage):
+    """Пик памяти за время замера сверх памяти в его начале, в КБ"""
+    with _memory_lock:
+        _fold_peak()
+        _memory_stages[:] = [other for other in _memory_stages if other is not stage]
+        if not _memory_stages and _memory_tracing["ours"]:
+            tracemalloc.stop()
+            _memory_tracing["ours"] = False
+    return (stage["peak"] - stage["start"]) // 1024
+
+
+@st.cache_resource
+def plugin_runs():
+    # Записи о запусках плагинов общие для всех сессий
+    return {"records": deque(maxlen=MAX_RECORDS), "lock": threading.Lock()}
+
+
+def new_record(plugin_name, plugin_hash, store):
+    record = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "plugin": plugin_name,
+        "plugin_hash": plugin_hash[:8],
+        "dataset": store.key if store is not None else None,
+        "messages": len(store) if store is not None else None,
+        "input_mb": round(sum(values.nbytes for values in store.columns().values()) / 2 ** 20, 2)
+        if store is not None else None,
+        "cached": False,
+        "memory_kb": None,
+        "error": None,
+    }
+    record.update({f"{stage}_s": None for stage in STAGES})
+    return record
+
+
+@contextmanager
+def measure(record, stage, profile=None, trace_memory=False):
+    """Замеряет время этапа stage, а с trace_memory — и пик памяти, выделенной за время этапа.
+
+    Память считает tracemalloc (numpy сообщает ему и о своих массивах).
+    compute плагинов идут параллельно, и память, выделенная соседним
+    плагином, тоже попадает в замер, так что это оценка сверху.
+    В record["memory_kb"] — наибольшее значение по этапам плагина.
+    """
+    memory = start_memory() if trace_memory else None
+    start = time.perf_counter()
+    if profile is not None:
+        profile.enable()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.disable()
+        record[f"{stage}_s"] = round(time.perf_counter() - start, 6)
+        if memory is not None:
+            record["memory_kb"] = max(record["memory_kb"] or 0, stop_memory(memory))
+
+
+def timed(func, record, stage, profile=None, trace_memory=False):
+    """Обёртка над func с замером этапа — для запуска в пуле потоков"""
+    def run(*args, **kwargs):
+        with measure(record, stage, profile, trace_memory):
+            return func(*args, **kwargs)
+    return run
+
+
+def finish(record):
+    runs = plugin_runs()
+    with runs["lock"]:
+        runs["records"].append(record)
+        if STATS_FILE:
+            try:
+                with open(STATS_FILE, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except OSError:
+                pass
+
+
+def to_jsonl(records):
+    return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+
+def profile_text(*profiles):
+    """Самые долгие по суммарному времени функции из одного или нескольких профилей"""
+    out = io.StringIO()
+    stats = None
+    for profile in profiles:
+        if profile is None:
+            continue
+        # Этап мог не выполняться (например, compute у плагина только с run_plugin)
+        profile.create_stats()
+        if not profile.stats:
+            continue
+        if stats is None:
+            stats = pstats.Stats(profile, stream=out)
+        else:
+            stats.add(profile)
+    if stats is None:
+        return ""
+    stats.sort_stats("cumulative").print_stats(PROFILE_LINES)
+    return out.getvalue()
+
+
+def show_records(container, records):
+    """Таблица замеров текущего запуска и выгрузка всех записей процесса"""
+    with container:
+        if records:
+            columns = ["plugin", "cached"] + [f"{stage}_s" for stage in STAGES] + ["memory_kb", "messages", "input_mb"]
+            st.dataframe(pd.DataFrame(records)[columns], hide_index=True)
+        runs = plugin_runs()
+        with runs["lock"]:
+            all_records = list(runs["records"])
+        st.download_button("Скачать журнал (JSON Lines)", to_jsonl(all_records),
+                           file_name="plugin_runs.jsonl", mime="application/jsonl")
@@ -1,10 +1,13 @@
-from datetime import datetime
 import streamlit as st
 import pandas as pd
+import numpy as np
 
+import gap_engine
+from chat_store import build_store
 
-def parse_date(date_str):
-    return datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S")
+DEFAULT_THRESHOLD_HOURS = 30
+# Пороги для ползунка: от четверти часа до месяца (в часах)
+THRESHOLD_OPTIONS = [0.25, 0.5, 1, 2, 3, 6, 12, 24, 30, 48, 72, 7 * 24, 14 * 24, 30 * 24]
 
 
 def human_readable_duration(seconds):
@@ -21,61 +24,112 @@ def human_readable_duration(seconds):
         return f"{int(seconds)}с"
 
 
-def run_plugin(data):
-    messages = data.get("messages", [])
-    chat_name = data.get("name", "Чат")
+def format_durations(seconds):
+    """human_readable_duration для массива секунд: каждое различное значение форматируется один раз"""
+    # Длительность от минуты выводится с точностью до минут
+    seconds = np.asarray(seconds)
+    values, inverse = np.unique(np.where(seconds >= 60, seconds // 60 * 60, seconds), return_inverse=True)
+    return np.array([human_readable_duration(value) for value in values.tolist()], dtype=object)[inverse]
 
-    if not messages:
-        st.warning("Нет сообщений в чате.")
-        return
 
-    st.subheader(f"Длинные паузы в чате — {chat_name}")
-    st.markdown("Будут показаны периоды, когда **никто не писал более 30 часов**.")
+def silences_frame(silences):
+    """Таблица пауз для вывода: времена — datetime, добавлена длительность текстом"""
+    frame = silences.assign(**{column: pd.to_datetime(silences[column], unit="s") for column in ("Начало", "Конец")})
+    frame.insert(2, "Длительность", format_durations(silences["Секунд"]))
+    return frame
 
-    # Сортируем сообщения по времени
-    messages_sorted = sorted(messages, key=lambda m: m.get("date"))
 
-    # Извлекаем все временные метки
-    timestamps = []
-    for msg in messages_sorted:
-        try:
-            dt = parse_date(msg["date"])
-            timestamps.append(dt)
-        except Exception:
-            continue
+def select_params(store):
+    chat_name = store.name
+
+    params = default_params(store)
+    if params is None:
+        st.warning("Нет сообщений в чате.")
+        return None
 
-    if len(timestamps) < 2:
+    st.subheader(f"Длинные паузы в чате — {chat_name}")
+    threshold_hours = st.select_slider(
+        "Минимальная длительность паузы", options=THRESHOLD_OPTIONS, value=params["threshold_hours"],
+        format_func=lambda hours: human_readable_duration(hours * 3600)
+    )
+    st.markdown(f"Будут показаны периоды, когда **никто не писал дольше {human_readable_duration(threshold_hours * 3600)}**.")
+    return {"threshold_hours": threshold_hours}
+
+
+def compute(store, params):
+    if len(store) < 2:
+        return None
+
+    # Паузы внутри каждого чата предрасчитаны в хранилище и отсортированы по убыванию,
+    # поэтому паузы не короче порога — это префикс, найденный двоичным поиском
+    gaps = store.gaps
+    n = gap_engine.count_at_least(gaps["gap"], params["threshold_hours"] * 3600)
+    gap = gaps["gap"][:n]
+    end = gaps["end"][:n]
+    end_times = store.ts[end]
+    breakers = store.sender[end]
+    chat_names = store.chat_names
+
+    # Таблица собирается из колонок; времена и длительности форматируются при выводе.
+    # Имена берутся ссылками из массива объектов, последний элемент — для NO_ID
+    silences = pd.DataFrame({
+        "Начало": end_times - gap,
+        "Конец": end_times,
+        "Секунд": gap,
+        "Прервал": np.array(store.users + [""], dtype=object)[breakers],
+    })
+    if len(chat_names) > 1:
+        silences["Чат"] = np.array(chat_names, dtype=object)[store.chat[end]]
+
+    # Кто чаще всех прерывал молчание
+    counts = np.bincount(breakers[breakers >= 0], minlength=len(store.users))
+    breaker_counts = [(store.user_name(code), int(counts[code])) for code in np.argsort(-counts, kind="stable") if counts[code]]
+    return {"threshold_hours": params["threshold_hours"], "silences": silences, "breakers": breaker_counts}
+
+
+def default_params(store):
+    if not len(store):
+        return None
+    return {"threshold_hours": DEFAULT_THRESHOLD_HOURS}
+
+
+def to_tables(result):
+    if not result:
+        return {"silences": [], "breakers": []}
+    silences = silences_frame(result["silences"])
+    for column in ("Начало", "Конец"):
+        silences[column] = silences[column].dt.strftime("%Y-%m-%d %H:%M")
+    return {
+        "silences": silences.to_dict("records"),
+        "breakers": [{"Пользователь": user, "Прервал пауз": count} for user, count in result["breakers"]],
+    }
+
+
+def render(result):
+    if result is None:
         st.warning("Недостаточно сообщений для анализа.")
         return
 
-    # Анализируем интервалы между сообщениями
-    SILENCE_THRESHOLD = 30 * 3600  # 30 часов в секундах
-    silence_periods = []
-
-    for i in range(1, len(timestamps)):
-        prev_time = timestamps[i - 1]
-        curr_time = timestamps[i]
-        delta = (curr_time - prev_time).total_seconds()
-
-        if delta >= SILENCE_THRESHOLD:
-            silence_periods.append({
-                "Начало": prev_time.strftime("%Y-%m-%d %H:%M"),
-                "Конец": curr_time.strftime("%Y-%m-%d %H:%M"),
-                "Длительность": human_readable_duration(delta),
-                "Секунд": int(delta)
-            })
-
-    if not silence_periods:
-        st.success("В чате не было пауз дольше 30 часов. Все активно!")
+    silences = result["silences"]
+    if silences.empty:
+        st.success(f"В чате не было пауз дольше {human_readable_duration(result['threshold_hours'] * 3600)}. Все активно!")
         return
 
-    # Сортируем по длительности (по убыванию)
-    silence_periods.sort(key=lambda p: p["Секунд"], reverse=True)
-
-    # Выводим таблицу
-    df = pd.DataFrame(silence_periods)
-    df_display = df.drop(columns=["Секунд"])
-    st.dataframe(df_display)
+    # Выводим таблицу; даты форматирует браузер
+    time_format = st.column_config.DatetimeColumn(format="YYYY-MM-DD HH:mm")
+    st.dataframe(silences_frame(silences).drop(columns=["Секунд"]),
+                 column_config={"Начало": time_format, "Конец": time_format})
 
     # Показываем количество найденных пауз
-    st.info(f"Найдено пауз: {len(df)}")
+    st.info(f"Найдено пауз: {len(silences)}")
+
+    st.write("### Кто прерывал молчание")
+    st.dataframe(pd.DataFrame(result["breakers"], columns=["Пользователь", "Прервал пауз"]), hide_index=True)
+
+
+def run_plugin(data, store=None):
+    if store is None:
+        store = build_store(data)
+    params = select_params(store)
+    if params is not None:
+        render(compute(store, params))
@@ -1,32 +1,77 @@
 from collections import defaultdict, Counter
 import streamlit as st
 import pandas as pd
+import numpy as np
 
-def run_plugin(data):
-    messages = data.get("messages", [])
-    chat_name = data.get("name", "Чат")
+from chat_store import build_store, ts_to_datetime
 
-    if not messages:
+# Сколько сообщений с наибольшим числом реакций показывать
+TOP_MESSAGES = 10
+
+
+def default_params(store):
+    if not len(store):
+        return None
+    return {}
+
+
+def select_params(store):
+    chat_name = store.name
+
+    params = default_params(store)
+    if params is None:
         st.warning("Нет сообщений для анализа.")
-        return
+        return None
 
     st.subheader(f"Анализ реакций в чате — {chat_name}")
+    return params
+
+
+def compute(store, params):
+    # Все счётчики предрасчитаны в хранилище (см. chat_store.reaction_matrix и соседние сводки)
+    emoji_counts = store.aggregates["emoji_totals"]["count"]
+    total = {store.emojis[emoji]: count for emoji, count in enumerate(emoji_counts.tolist()) if count}
+
+    # Используем recent для определения пользователей
+    matrix = store.reaction_matrix
+    by_user = defaultdict(dict)
+    for user, emoji, count in zip(matrix["user"].tolist(), matrix["emoji"].tolist(), matrix["count"].tolist()):
+        by_user[store.user_name(user)][store.emojis[emoji]] = count
 
-    # --- 1. Счётчики ---
-    total_emoji_counts = Counter()            # emoji -> общее количество
-    user_emoji_counts = defaultdict(Counter)  # user -> (emoji -> count)
+    # Самые популярные сообщения и реакции, полученные авторами, — из итогов по сообщениям
+    message_totals = store.aggregates["message_reactions"]
+    rows, totals = message_totals["msg"][:TOP_MESSAGES], message_totals["total"][:TOP_MESSAGES]
+    top_messages = [
+        {"id": msg_id, "Дата": ts_to_datetime(ts).strftime("%Y-%m-%d %H:%M"),
+         "Автор": store.user_name(sender) if sender >= 0 else "", "Реакций": count}
+        for msg_id, ts, sender, count in zip(store.ids[rows].tolist(), store.ts[rows].tolist(),
+                                             store.sender[rows].tolist(), totals.tolist())
+    ]
+    authors = store.sender[message_totals["msg"]]
+    valid = authors >= 0
+    received = np.bincount(authors[valid], weights=message_totals["total"][valid], minlength=len(store.users))
+    by_author = [(store.user_name(user), int(received[user])) for user in np.argsort(-received, kind="stable") if received[user]]
 
-    for msg in messages:
-        for reaction in msg.get("reactions", []):
-            emoji = reaction.get("emoji")
-            count = reaction.get("count", 0)
-            total_emoji_counts[emoji] += count
+    return {"total": total, "by_user": dict(by_user), "top_messages": top_messages, "received": by_author}
 
-            # Используем recent для определения пользователей
-            for entry in reaction.get("recent", []):
-                user = entry.get("from")
-                if user and emoji:
-                    user_emoji_counts[user][emoji] += 1
+
+def to_tables(result):
+    total = sorted(result["total"].items(), key=lambda item: item[1], reverse=True)
+    return {
+        "total": [{"Эмодзи": emoji, "Всего": count} for emoji, count in total],
+        "by_user": [
+            {"Пользователь": user, "Эмодзи": emoji, "Количество": count}
+            for user, counts in result["by_user"].items()
+            for emoji, count in counts.items()
+        ],
+        "top_messages": result["top_messages"],
+        "received": [{"Автор": user, "Получено реакций": count} for user, count in result["received"]],
+    }
+
+
+def render(result):
+    total_emoji_counts = result["total"]
+    user_emoji_counts = result["by_user"]
 
     # --- 2. Таблица: общее количество эмодзи ---
     st.markdown("### 🔝 Самые популярные реакции")
@@ -39,19 +84,12 @@ def run_plugin(data):
 
     # --- 3. Таблица: кто что ставил (только recent) ---
     st.markdown("### 👥 Кто какие реакции ставил (по доступным данным)")
+    users = sorted(user_emoji_counts.keys())
     if user_emoji_counts:
-        users = sorted(user_emoji_counts.keys())
-        all_emojis = sorted({emoji for counter in user_emoji_counts.values() for emoji in counter})
-
-        table = []
-        for user in users:
-            row = {"Пользователь": user}
-            for emoji in all_emojis:
-                row[emoji] = user_emoji_counts[user].get(emoji, 0)
-            table.append(row)
-
-        df_users = pd.DataFrame(table)
-        st.dataframe(df_users.set_index("Пользователь"))
+        df_users = pd.DataFrame.from_dict(user_emoji_counts, orient="index").fillna(0).astype(int)
+        df_users = df_users.reindex(index=users, columns=sorted(df_users.columns))
+        df_users.index.name = "Пользователь"
+        st.dataframe(df_users)
     else:
         st.info("Нет информации о пользователях, поставивших реакции.")
 
@@ -59,9 +97,26 @@ def run_plugin(data):
     st.markdown("### 🔍 Индивидуальный анализ")
     selected_user = st.selectbox("Выберите пользователя", [""] + users)
     if selected_user:
-        top_emojis = user_emoji_counts[selected_user].most_common()
+        top_emojis = Counter(user_emoji_counts[selected_user]).most_common()
         if top_emojis:
             df_user = pd.DataFrame(top_emojis, columns=["Эмодзи", "Количество"])
             st.dataframe(df_user)
         else:
             st.write("Этот пользователь не ставил реакций (или не попал в recent).")
+
+    # --- 5. Сообщения, собравшие больше всего реакций, и авторы ---
+    st.markdown("### 🏆 Сообщения с наибольшим числом реакций")
+    if result["top_messages"]:
+        st.dataframe(pd.DataFrame(result["top_messages"]), hide_index=True)
+        st.markdown("### 📨 Сколько реакций получили авторы")
+        st.dataframe(pd.DataFrame(result["received"], columns=["Автор", "Получено реакций"]), hide_index=True)
+    else:
+        st.info("Нет сообщений с реакциями.")
+
+
+def run_plugin(data, store=None):
+    if store is None:
+        store = build_store(data)
+    params = select_params(store)
+    if params is not None:
+        render(compute(store, params))
@@ -1,62 +1,103 @@
 from collections import defaultdict
 import streamlit as st
 import networkx as nx
-import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.figure import Figure
 
-def run_plugin(data):
-    messages = data.get("messages", [])
-    chat_name = data.get("name", "Чат")
+import charts
+from chat_store import build_store
 
-    if not messages:
+# Сколько самых частых связей показывать по умолчанию
+DEFAULT_TOP_EDGES = 50
+# До скольких участников они все выбраны в списке по умолчанию
+MAX_PRESELECTED_USERS = 50
+# До скольких узлов граф рисуется по кругу с подписями рёбер
+MAX_CIRCULAR_NODES = 30
+
+
+def participants_by_activity(store):
+    # Участники, написавшие хотя бы одно сообщение, от самых активных
+    message_counts = store.user_totals["messages"]
+    codes = np.argsort(-message_counts, kind="stable")
+    return [store.user_name(code) for code in codes[message_counts[codes] > 0].tolist()]
+
+
+def default_params(store):
+    # По умолчанию анализируются все участники и самые частые связи между ними
+    if not participants_by_activity(store):
+        return None
+    return {"users": None, "top_k": DEFAULT_TOP_EDGES}
+
+
+def select_params(store):
+    chat_name = store.name
+
+    if not len(store):
         st.warning("Нет сообщений для анализа.")
-        return
+        return None
 
     st.subheader(f"Сетевой анализ взаимодействий — {chat_name}")
 
     # Собираем всех участников
-    participants = sorted(set(msg.get("from") for msg in messages if msg.get("from")))
+    participants = participants_by_activity(store)
     if not participants:
         st.warning("Не удалось определить участников.")
-        return
+        return None
 
-    # Интерфейс выбора пользователей
-    selected_users = st.multiselect("Выберите пользователей для анализа", participants, default=participants)
-    if not selected_users:
-        st.info("Выберите хотя бы одного пользователя.")
-        return
+    # Интерфейс выбора пользователей: в больших группах по умолчанию — все участники без перечисления
+    default = sorted(participants) if len(participants) <= MAX_PRESELECTED_USERS else []
+    selected_users = st.multiselect("Выберите пользователей для анализа (пусто — все участники)",
+                                    sorted(participants), default=default)
+    top_k = st.number_input("Показывать самые частые связи (0 — все)", min_value=0, value=DEFAULT_TOP_EDGES)
+    return {"users": selected_users or None, "top_k": int(top_k)}
 
-    # Карта: ID сообщения → отправитель
-    id_to_user = {}
-    for msg in messages:
-        msg_id = msg.get("id")
-        sender = msg.get("from")
-        if msg_id is not None and sender in selected_users:
-            id_to_user[msg_id] = sender
-
-    # Подсчёт взаимодействий (ответов)
-    interaction_counts = defaultdict(lambda: defaultdict(int))
-    for msg in messages:
-        sender = msg.get("from")
-        reply_id = msg.get("reply_to_message_id")
-
-        if sender in selected_users and reply_id:
-            replied_user = id_to_user.get(reply_id)
-            if replied_user and replied_user in selected_users and replied_user != sender:
-                interaction_counts[sender][replied_user] += 1
 
-    if not interaction_counts:
-        st.info("Нет ответов между выбранными пользователями.")
-        return
+def compute(store, params):
+    # Рёбра ответов извлечены при построении хранилища (см. chat_store.reply_edges),
+    # выбор пользователей — это только фильтр по строкам разреженной матрицы
+    edges = store.reply_edges
+    source, target, count = edges["source"], edges["target"], edges["count"]
+    if params.get("users") is not None:
+        user_codes = {user: code for code, user in enumerate(store.users)}
+        selected = np.zeros(len(store.users), dtype=bool)
+        selected[[user_codes[user] for user in params["users"]]] = True
+        keep = selected[source] & selected[target]
+        source, target, count = source[keep], target[keep], count[keep]
 
+    # Самые частые связи: частичный отбор вместо сортировки всех рёбер
+    if params.get("top_k") and params["top_k"] < len(count):
+        top = np.argpartition(-count, params["top_k"])[:params["top_k"]]
+        top = top[np.argsort(-count[top], kind="stable")]
+    else:
+        top = np.argsort(-count, kind="stable")
+
+    interaction_counts = defaultdict(dict)
+    for sender, replied_user, replies in zip(source[top].tolist(), target[top].tolist(), count[top].tolist()):
+        interaction_counts[store.user_name(sender)][store.user_name(replied_user)] = replies
+    return dict(interaction_counts)
+
+
+def to_tables(interaction_counts):
+    rows = [
+        {"Кто отвечает": sender, "Кому": receiver, "Ответов": count}
+        for sender, replies in interaction_counts.items()
+        for receiver, count in replies.items()
+    ]
+    return {"replies": rows}
+
+
+def draw_figure(interaction_counts):
     # Построение графа
     G = nx.DiGraph()
     for sender, replies in interaction_counts.items():
         for receiver, count in replies.items():
             G.add_edge(sender, receiver, weight=count)
 
-    plt.figure(figsize=(10, 8))
-    pos = nx.circular_layout(G)
-    # pos = nx.spring_layout(G, seed=42)
+    fig = Figure(figsize=(10, 8))
+    ax = fig.subplots()
+    # Большой граф по кругу нечитаем: раскладка пружинами, без подписей рёбер
+    small = G.number_of_nodes() <= MAX_CIRCULAR_NODES
+    pos = nx.circular_layout(G) if small else nx.spring_layout(G, seed=42)
     raw_weights = [G[u][v]['weight'] for u, v in G.edges()]
     max_weight = max(raw_weights)
     min_weight = min(raw_weights)
@@ -67,11 +108,29 @@ def run_plugin(data):
     else:
         edge_weights = [1 + 4 * (w - min_weight) / (max_weight - min_weight) for w in raw_weights]
 
-    nx.draw(G, pos, with_labels=True, node_color='lightblue', node_size=2000,
-            font_size=10, arrows=True, width=edge_weights)
+    nx.draw(G, pos, ax=ax, with_labels=True, node_color='lightblue', node_size=2000 if small else 300,
+            font_size=10 if small else 7, arrows=True, width=edge_weights)
+
+    if small:
+        edge_labels = {(u, v): G[u][v]['weight'] for u, v in G.edges()}
+        nx.draw_networkx_edge_labels(G, pos, edge_labels=edge_labels, font_size=9, ax=ax)
+
+    ax.set_title("Кто кому отвечает (среди выбранных пользователей)", fontsize=14)
+    return fig
+
+
+def render(interaction_counts):
+    if not interaction_counts:
+        st.info("Нет ответов между выбранными пользователями.")
+        return
+
+    # Раскладка графа — самая долгая часть, картинка кэшируется (см. charts.render_scope)
+    charts.pyplot(lambda: draw_figure(interaction_counts))
 
-    edge_labels = {(u, v): G[u][v]['weight'] for u, v in G.edges()}
-    nx.draw_networkx_edge_labels(G, pos, edge_labels=edge_labels, font_size=9)
 
-    plt.title("Кто кому отвечает (среди выбранных пользователей)", fontsize=14)
-    st.pyplot(plt)
+def run_plugin(data, store=None):
+    if store is None:
+        store = build_store(data)
+    params = select_params(store)
+    if params is not None:
+        render(compute(store, params))
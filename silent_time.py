@@ -1,12 +1,14 @@
-from collections import defaultdict
-from datetime import datetime
+import pandas as pd
 import streamlit as st
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import numpy as np
 
+import charts
+import gap_engine
+from chat_store import build_store, ts_to_datetime
 
-def parse_date(date_str):
-    return datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S")
+# Сколько самых долгих пауз пользователей показывать
+LONGEST_GAPS = 10
 
 
 def human_readable_seconds(seconds):
@@ -19,78 +21,125 @@ def human_readable_seconds(seconds):
         return f"{int(seconds // 3600)}ч"
 
 
-def run_plugin(data):
-    messages = data.get("messages", [])
-    chat_name = data.get("name", "Чат")
+def default_params(store):
+    if not len(store):
+        return None
+    return {}
 
-    if not messages:
-        st.warning("Нет сообщений в чате.")
-        return
 
-    # Сортируем сообщения по дате
-    messages_sorted = sorted(messages, key=lambda m: m.get('date'))
-
-    # Собираем для каждого пользователя список времен сообщений
-    user_times = defaultdict(list)
-    for msg in messages_sorted:
-        try:
-            sender = msg['from']
-            dt = parse_date(msg['date'])
-            user_times[sender].append(dt)
-        except Exception:
-            continue
-
-    # Вычисляем паузы между последовательными сообщениями каждого пользователя (в секундах)
-    user_gaps = defaultdict(list)
-    for user, times in user_times.items():
-        for i in range(1, len(times)):
-            delta = (times[i] - times[i - 1]).total_seconds()
-            if delta > 0:
-                user_gaps[user].append(delta)
-
-    if not any(user_gaps.values()):
+def select_params(store):
+    params = default_params(store)
+    if params is None:
+        st.warning("Нет сообщений в чате.")
+    return params
+
+
+def compute(store, params):
+    # Паузы между последовательными сообщениями каждого пользователя (в хранилище они уже отсортированы)
+    valid = store.sender >= 0
+    sender = store.sender[valid]
+    gap, end = gap_engine.group_gaps(store.ts[valid], sender)
+
+    # Корзины: степени двойки от 1 секунды до максимальной паузы, все пользователи за один проход
+    counts, bins = gap_engine.log2_histogram(gap, sender[end], len(store.users))
+    totals = counts.sum(axis=1)
+    if not totals.any():
+        return None
+
+    # Пользователи в порядке их первого сообщения
+    codes, first_rows = np.unique(sender, return_index=True)
+    codes = codes[np.argsort(first_rows)]
+
+    # Распределение пауз считаем сразу для всех, выбор пользователей влияет только на отрисовку
+    user_percentages = {}
+    for code in codes[totals[codes] > 0].tolist():
+        percentages = counts[code] / totals[code] * 100
+        user_percentages[store.user_name(code)] = np.where(percentages < 1, 0, percentages).tolist()
+
+    bins = bins.tolist()
+    bin_labels = [
+        f"{human_readable_seconds(bins[i])}–{human_readable_seconds(bins[i + 1])}"
+        for i in range(len(bins) - 1)
+    ]
+
+    # Самые долгие паузы: частичный отбор, а не сортировка всех пауз
+    ts = store.ts[valid]
+    longest = [
+        {
+            "Пользователь": store.user_name(int(sender[end[i]])),
+            "С": ts_to_datetime(ts[end[i]] - gap[i]).strftime("%Y-%m-%d %H:%M"),
+            "По": ts_to_datetime(ts[end[i]]).strftime("%Y-%m-%d %H:%M"),
+            "Длительность": human_readable_seconds(gap[i]),
+        }
+        for i in gap_engine.top_gaps(gap, LONGEST_GAPS).tolist()
+    ]
+    return {"chat_name": store.name, "bin_labels": bin_labels, "user_percentages": user_percentages,
+            "longest": longest}
+
+
+def render(result):
+    if result is None:
         st.warning("Не удалось вычислить временные паузы.")
         return
 
-    # Определяем бины: степени двойки от 1 секунды до максимальной паузы
-    max_gap = max([max(gaps) for gaps in user_gaps.values() if gaps])
-    max_exp = int(np.ceil(np.log2(max_gap))) if max_gap > 0 else 10
-    bins = [2 ** i for i in range(max_exp + 1)]
+    st.subheader(f"Анализ временных пауз между сообщениями — чат: {result['chat_name']}")
 
-    st.subheader(f"Анализ временных пауз между сообщениями — чат: {chat_name}")
-
-    all_users = list(user_gaps.keys())
+    all_users = list(result["user_percentages"].keys())
     selected_users = st.multiselect("Выберите пользователей для отображения", all_users, default=all_users)
 
     if not selected_users:
         st.warning("Выберите хотя бы одного пользователя.")
         return
 
-    plt.figure(figsize=(12, 6))
-
-    for user in selected_users:
-        gaps = user_gaps[user]
-        counts, bin_edges = np.histogram(gaps, bins=bins)
-        total = counts.sum()
-        if total > 0:
-            percentages = (counts / total) * 100
-            percentages = np.where(percentages < 1, 0, percentages)
-        else:
-            percentages = counts
-
-        bin_labels = [
-            f"{human_readable_seconds(bin_edges[i])}–{human_readable_seconds(bin_edges[i + 1])}"
-            for i in range(len(bin_edges) - 1)
-        ]
-        plt.plot(bin_labels, percentages, marker='o', label=user)
-
-    plt.xlabel("Время паузы между сообщениями")
-    plt.ylabel("Доля пауз (%)")
-    plt.title("Распределение временных пауз (в процентах от общего числа пауз)")
-    plt.xticks(rotation=45)
-    plt.legend()
-    plt.grid(True)
-    plt.tight_layout()
-
-    st.pyplot(plt)
-
+    charts.show(lambda: draw_chart(result, selected_users), lambda: draw_figure(result, selected_users),
+                key=tuple(selected_users))
+
+    st.write("### Самые долгие паузы пользователей")
+    st.dataframe(pd.DataFrame(result["longest"]), hide_index=True)
+
+
+def to_tables(result):
+    if result is None:
+        return {"gaps": [], "longest": []}
+    rows = [
+        {"Пользователь": user, "Пауза": label, "Доля, %": share}
+        for user, percentages in result["user_percentages"].items()
+        for label, share in zip(result["bin_labels"], percentages)
+    ]
+    return {"gaps": rows, "longest": result["longest"]}
+
+
+def draw_chart(result, users=None):
+    if users is None:
+        users = list(result["user_percentages"])
+    data = charts.series_frame(result["bin_labels"], {user: result["user_percentages"][user] for user in users})
+    return charts.line_chart(data, "Время паузы между сообщениями", "Доля пауз (%)",
+                             "Распределение временных пауз (в процентах от общего числа пауз)",
+                             x_sort=result["bin_labels"])
+
+
+def draw_figure(result, users=None):
+    if users is None:
+        users = list(result["user_percentages"])
+
+    fig = Figure(figsize=(12, 6))
+    ax = fig.subplots()
+    for user in users:
+        ax.plot(result["bin_labels"], result["user_percentages"][user], marker='o', label=user)
+
+    ax.set_xlabel("Время паузы между сообщениями")
+    ax.set_ylabel("Доля пауз (%)")
+    ax.set_title("Распределение временных пауз (в процентах от общего числа пауз)")
+    ax.tick_params(axis="x", labelrotation=45)
+    ax.legend()
+    ax.grid(True)
+    fig.tight_layout()
+    return fig
+
+
+def run_plugin(data, store=None):
+    if store is None:
+        store = build_store(data)
+    params = select_params(store)
+    if params is not None:
+        render(compute(store, params))
@@ -1,38 +1,27 @@
-from collections import defaultdict
-from datetime import datetime
 import streamlit as st
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 
+import charts
+from chat_store import build_store, day_weekday, ts_to_date, user_bucket_counts
 
-def parse_date(date_str):
-    return datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S")
 
+def default_params(store):
+    # По умолчанию анализируется вся история чата
+    if not len(store):
+        return None
+    return {"start_date": ts_to_date(store.ts[0]), "end_date": ts_to_date(store.ts[-1])}
 
-def run_plugin(data):
-    messages = data.get("messages", [])
-    chat_name = data.get("name", "Чат")
 
-    if not messages:
-        st.warning("Нет сообщений в чате.")
-        return
+def select_params(store):
+    chat_name = store.name
 
-    # Парсим даты сообщений
-    for msg in messages:
-        try:
-            dt = parse_date(msg['date'])
-            msg['parsed_date'] = dt
-            msg['date_only'] = dt.date()
-        except Exception:
-            msg['parsed_date'] = None
-            msg['date_only'] = None
-
-    valid_dates = [msg['date_only'] for msg in messages if msg['date_only'] is not None]
-    if not valid_dates:
-        st.warning("Нет валидных дат в сообщениях.")
-        return
+    defaults = default_params(store)
+    if defaults is None:
+        st.warning("Нет сообщений в чате.")
+        return None
 
-    min_date = min(valid_dates)
-    max_date = max(valid_dates)
+    min_date = defaults["start_date"]
+    max_date = defaults["end_date"]
 
     st.subheader(f"Активность пользователей по дням в чате: {chat_name}")
 
@@ -45,44 +34,69 @@ def run_plugin(data):
 
     if start_date > end_date:
         st.error("Начало анализа не может быть позже конца.")
-        return
+        return None
 
-    # Фильтрация сообщений по дате (включительно)
-    filtered_msgs = [msg for msg in messages if msg['date_only'] is not None and start_date <= msg['date_only'] <= end_date]
+    return {"start_date": start_date, "end_date": end_date}
 
-    if not filtered_msgs:
-        st.warning("Нет сообщений в выбранном диапазоне дат.")
-        return
 
-    # Считаем активность по дням
-    user_week_counts = defaultdict(lambda: [0]*7)
+def compute(store, params):
+    # Фильтрация по дате (включительно): берём ячейки куба активности за выбранные дни
+    cube = store.cube
+    rows = store.cube_slice(params["start_date"], params["end_date"])
 
-    for msg in filtered_msgs:
-        try:
-            sender = msg['from']
-            day = msg['parsed_date'].day
-            shifted_day  = day % 7
-            user_week_counts[sender][shifted_day] += 1
-        except Exception:
-            continue
+    # Считаем активность по дням недели
+    counts = user_bucket_counts(cube["user"][rows], day_weekday(cube["day"][rows]), 7, len(store.users),
+                                weights=cube["messages"][rows])
+    return {store.user_name(code): counts[code].tolist() for code in counts.any(axis=1).nonzero()[0]}
+
+
+WEEK_LABELS = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
 
-    if not user_week_counts:
-        st.warning("Нет данных для построения графика.")
-        return
 
+def to_tables(user_week_counts):
+    rows = [
+        {"Пользователь": user, "День недели": day, "Сообщений": count}
+        for user, counts in user_week_counts.items()
+        for day, count in zip(WEEK_LABELS, counts)
+    ]
+    return {"weekdays": rows}
+
+
+def draw_chart(user_week_counts):
+    data = charts.series_frame(WEEK_LABELS, user_week_counts)
+    return charts.line_chart(data, "День недели", "Количество сообщений", "Активность пользователей по дням",
+                             x_sort=WEEK_LABELS)
+
+
+def draw_figure(user_week_counts):
     days = list(range(7))
-    week_labels = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
 
-    plt.figure(figsize=(12, 6))
+    fig = Figure(figsize=(12, 6))
+    ax = fig.subplots()
     for user, counts in user_week_counts.items():
-        plt.plot(days, counts, label=user, marker='o')
+        ax.plot(days, counts, label=user, marker='o')
+
+    ax.set_xticks(days, WEEK_LABELS)
+    ax.set_xlabel("День недели")
+    ax.set_ylabel("Количество сообщений")
+    ax.set_title("Активность пользователей по дням")
+    ax.legend()
+    ax.grid(True)
+    fig.tight_layout()
+    return fig
+
+
+def render(user_week_counts):
+    if not user_week_counts:
+        st.warning("Нет сообщений в выбранном диапазоне дат.")
+        return
+
+    charts.show(lambda: draw_chart(user_week_counts), lambda: draw_figure(user_week_counts))
 
-    plt.xticks(days, week_labels)
-    plt.xlabel("День недели")
-    plt.ylabel("Количество сообщений")
-    plt.title("Активность пользователей по дням")
-    plt.legend()
-    plt.grid(True)
-    plt.tight_layout()
 
-    st.pyplot(plt)
+def run_plugin(data, store=None):
+    if store is None:
+        store = build_store(data)
+    params = select_params(store)
+    if params is not None:
+        render(compute(store, params))